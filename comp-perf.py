@@ -4,11 +4,16 @@ import numpy;
 from tqdm import tqdm;
 import numpy as np;
 import subprocess;
+import argparse;
+import math;
+import sys;
+import zlib;
+import zstandard as zstd;
+import brotli;
+import snappy;
 
 # for f in os.listdir('d'):
 #     print(f)
-if not os.access('tmp', os.R_OK):
-    os.mkdir('tmp')
 
 
 def zcompress_one(level):
@@ -95,17 +100,34 @@ def gdecompress_one(level):
     diff = (end - start) / 1_000_000
     return diff
 
+# Warms up, then samples until the 95% confidence interval of the mean is within --ci of it (and
+# at least --min-samples were taken) or the time budget runs out. sample() returns its time in ms.
+def measure(sample, time_budget_in_secs):
+    for i in range(0, args.warmup):
+        sample()
+    level_end = time.time() + time_budget_in_secs
+    times = []
+    while len(times) == 0 or time.time() < level_end:
+        times.append(sample())
+        if len(times) >= args.min_samples and ci95(times) <= args.ci * np.mean(times):
+            break
+    return times
+
+# half width of the 95% confidence interval of the mean, in the unit of the samples
+def ci95(times):
+    if len(times) < 2:
+        return float('inf')
+    return 1.96 * np.std(times, ddof=1) / math.sqrt(len(times))
+
+def time_stats(times):
+    # samples, mean, std, p25, p75, ci95 (all in ms)
+    return [len(times), np.mean(times), np.std(times), np.percentile(times, 25, method = 'midpoint'), np.percentile(times, 75, method = 'midpoint'), ci95(times)]
+
 def run_decompress_bench(decompress, levels, time_budget_in_secs):
-    base_size = os.lstat('extr.in').st_size
     results = []
     for level in tqdm(levels):
-        level_end = time.time() + time_budget_in_secs
-        dtime = []
-        while time.time() < level_end:
-            res = decompress(level)
-            dtime.append(res)
-
-        results.append([level, len(dtime), np.mean(dtime), np.std(dtime), np.percentile(dtime, 25, interpolation = 'midpoint'), np.percentile(dtime, 75, interpolation = 'midpoint') ])
+        dtime = measure(lambda: decompress(level), time_budget_in_secs)
+        results.append([level] + time_stats(dtime))
     return results
 
 
@@ -113,17 +135,88 @@ def run_compress_bench(compress, levels, time_budget_in_secs):
     base_size = os.lstat('extr.in').st_size
     results = []
     for level in tqdm(levels):
-        level_end = time.time() + time_budget_in_secs
-        ctime = []
-        ratio = 0
-        while time.time() < level_end:
+        sizes = []
+        def sample():
             res = compress(level)
-            ctime.append(res[0])
-            ratio = base_size / res[1]
+            sizes.append(res[1])
+            return res[0]
+        ctime = measure(sample, time_budget_in_secs)
+        results.append([level, base_size / sizes[-1]] + time_stats(ctime))
+    return results
+
+# In-process mode: the same codecs sim.py uses, on an in-memory copy of the input, so we time the
+# codec and not process start-up and file I/O. Each level gets one compressor reused across samples.
+def zstd_codec(level):
+    cctx = zstd.ZstdCompressor(level=level)
+    dctx = zstd.ZstdDecompressor()
+    return cctx.compress, dctx.decompress
+
+def zstd_fast_codec(level):
+    return zstd_codec(-level)
+
+def zlib_codec(level):
+    return (lambda data: zlib.compress(data, level=level)), zlib.decompress
+
+def brotli_codec(level):
+    return (lambda data: brotli.compress(data, quality=level)), brotli.decompress
+
+def snappy_codec(level):
+    return snappy.compress, snappy.decompress
 
-        results.append([level, ratio, len(ctime), np.mean(ctime), np.std(ctime), np.percentile(ctime, 25, interpolation = 'midpoint'), np.percentile(ctime, 75, interpolation = 'midpoint') ])
+def time_samples(fn, data, time_budget_in_secs):
+    last = [None]
+    def sample():
+        start = time.perf_counter_ns()
+        last[0] = fn(data)
+        return (time.perf_counter_ns() - start) / 1_000_000
+    times = measure(sample, time_budget_in_secs)
+    return last[0], times
+
+def throughput_stats(raw_size, times):
+    # MB/s of raw data, then the same stats as the subprocess mode
+    return [raw_size / 1_000_000 / (np.mean(times) / 1000)] + time_stats(times)
+
+def run_inprocess_bench(codec, levels, data, time_budget_in_secs):
+    results = []
+    for level in tqdm(levels):
+        compress, decompress = codec(level)
+        compressed, ctime = time_samples(compress, data, time_budget_in_secs / 2)
+        restored, dtime = time_samples(decompress, compressed, time_budget_in_secs / 2)
+        if restored != data:
+            raise Exception(f'level {level} did not round trip')
+        results.append([level, len(data) / len(compressed)] + throughput_stats(len(data), ctime) + throughput_stats(len(data), dtime))
     return results
 
+# Compares every *mean column of a results csv with the same row (method, level) of a baseline.
+# Slower by more than --regression and by more than both confidence intervals is a regression.
+def load_csv(file_name):
+    with open(file_name) as f:
+        header = f.readline().strip().split(',')
+        rows = dict()
+        for line in f:
+            cols = line.strip().split(',')
+            rows[(cols[0], cols[1])] = dict(zip(header, cols))
+    return header, rows
+
+def compare_baseline(results_file, baseline_file):
+    header, rows = load_csv(results_file)
+    _, base_rows = load_csv(baseline_file)
+    regressions = 0
+    for key, row in rows.items():
+        base = base_rows.get(key)
+        if base == None:
+            continue
+        for col in [c for c in header if c.endswith('mean')]:
+            ci_col = col.replace('mean', 'ci95')
+            cur, prev = float(row[col]), float(base[col])
+            # older baselines have no ci columns
+            noise = float(row[ci_col]) + float(base[ci_col]) if ci_col in base else 0
+            if cur - prev > prev * args.regression and cur - prev > noise:
+                print(f'REGRESSION {key[0]} level {key[1]} {col}: {prev:.3f}ms -> {cur:.3f}ms (+{(cur / prev - 1) * 100:.1f}%)')
+                regressions += 1
+    print(f'{regressions} regressions vs {baseline_file}')
+    return regressions
+
 def dump_array(outfile, header, arr):
     for l in arr:
         outfile.write(f'{header},')
@@ -132,22 +225,67 @@ def dump_array(outfile, header, arr):
 
 
 TIME_PER_LEVEL = 60
+# subprocess mode, kept as a reference for what the command line tools do
 algos = [
     ['zstd', list(range(0, 11)), zcompress_one, zdecompress_one],
     ['gzip', list(range(1, 10)), gcompress_one, gdecompress_one],
     ['zfast', list(range(1, 10)), zcompress_fast_one, zdecompress_fast_one],
 ]
 
+# same level ranges as above, zlib stands in for gzip (same deflate, without the gzip framing)
+inprocess_algos = [
+    ['zstd', list(range(0, 11)), zstd_codec],
+    ['zlib', list(range(1, 10)), zlib_codec],
+    ['zfast', list(range(1, 10)), zstd_fast_codec],
+    ['brotli', list(range(0, 12)), brotli_codec],
+    ['snappy', [0], snappy_codec],
+]
+
 TIME_PER_LEVEL = 100
-suffix = '-3'
+suffix = '3'
+
+parser = argparse.ArgumentParser(description="Codec speed benchmark")
+parser.add_argument('--mode', choices=['inprocess', 'subprocess'], default='inprocess',
+    help='Time the libraries in memory or the zstd/gzip command line tools (default inprocess)')
+parser.add_argument('--input', help='File to compress, the subprocess mode always uses extr.in (default extr.in)', default='extr.in')
+parser.add_argument('--time-per-level', type=float, help=f'Most seconds spent on each level, sampling usually stops earlier, see --ci (default {TIME_PER_LEVEL})', default=TIME_PER_LEVEL)
+parser.add_argument('--warmup', type=int, help='Untimed runs before sampling each level (default 3)', default=3)
+parser.add_argument('--min-samples', type=int, help='Samples taken before checking --ci (default 10)', default=10)
+parser.add_argument('--ci', type=float, help='Stop sampling once the 95%% confidence interval is within this fraction of the mean (default 0.02)', default=0.02)
+parser.add_argument('--cpu', type=int, help='Pin the benchmark (and the tools it runs) to this cpu', default=None)
+parser.add_argument('--baseline', help='Results csv of a previous run to flag regressions against, exits with 1 if any', default=None)
+parser.add_argument('--regression', type=float, help='Slowdown of a mean that counts as a regression (default 0.1)', default=0.1)
+parser.add_argument('--suffix', help=f'Suffix of the csv files, they are named inprocess-SUFFIX.csv or decompress-SUFFIX.csv (default {suffix})', default=suffix)
+args = parser.parse_args()
+
+if args.cpu != None:
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {args.cpu})
+    else:
+        print('cpu pinning is not supported on this platform, running unpinned')
+
+if args.mode == 'inprocess':
+    results_file = f'inprocess-{args.suffix}.csv'
+    with open(args.input, 'rb') as f:
+        data = f.read()
+    with open(results_file, 'w') as stats:
+        stats.write('method,level,ratio,c_mb_s,c_samples,c_mean,c_std,c_p25,c_p75,c_ci95,d_mb_s,d_samples,d_mean,d_std,d_p25,d_p75,d_ci95\n')
+        for a in inprocess_algos:
+            dump_array(stats, a[0], run_inprocess_bench(a[2], a[1], data, args.time_per_level))
+else:
+    if not os.access('tmp', os.R_OK):
+        os.mkdir('tmp')
 
-# with open(f'compress{suffix}.csv', 'w') as stats:
-#     stats.write('method,level,ratio,samples,mean,std,p25,p75\n')
-#     for a in algos:
-#         dump_array(stats, a[0], run_compress_bench(a[2], a[1], TIME_PER_LEVEL))
+    # with open(f'compress-{args.suffix}.csv', 'w') as stats:
+    #     stats.write('method,level,ratio,samples,mean,std,p25,p75,ci95\n')
+    #     for a in algos:
+    #         dump_array(stats, a[0], run_compress_bench(a[2], a[1], args.time_per_level))
 
-with open(f'decompress{suffix}.csv', 'w') as stats:
-    stats.write('method,level,samples,mean,std,p25,p75\n')
-    for a in algos:
-        dump_array(stats, a[0], run_decompress_bench(a[3], a[1], TIME_PER_LEVEL))
+    results_file = f'decompress-{args.suffix}.csv'
+    with open(results_file, 'w') as stats:
+        stats.write('method,level,samples,mean,std,p25,p75,ci95\n')
+        for a in algos:
+            dump_array(stats, a[0], run_decompress_bench(a[3], a[1], args.time_per_level))
 
+if args.baseline != None and compare_baseline(results_file, args.baseline) > 0:
+    sys.exit(1)
@@ -1,6 +1,7 @@
 import argparse;
 import json
-import random;
+import multiprocessing;
+import numpy as np;
 
 
 # N_ACTIONS = 20
@@ -15,70 +16,116 @@ default_config = {
     "actionsPerDecision": 15, #number of arms in each decision
     "featuresPerAction": 30, #how big is each action
     "sharedCount": 30, #how big is the shared context
+    "popularity": "uniform", # how actions are picked: uniform, zipf or drift
+    "zipfExponent": 1.1, # skew of zipf and drift popularity
+    "driftRate": 0.5, # with drift, how many ranks the popularity shifts by per decision
 }
 
-def gen_action(config):
-    res = dict()
-    for i in range(0, config["featuresPerAction"]):
-        res[f'f_{i}'] = random.random()
-    return res
+# decisions formatted per worker task
+CHUNK_DECISIONS = 1000
 
-def gen_action_set(config):
+# Everything is generated in bulk with numpy and formatted with the float repr json.dumps uses, so
+# the output is the same json as dumping the dicts. Every chunk has its own rng derived from the
+# seed, so a log only depends on the seed and not on how many jobs made it.
+
+def format_features(prefix, values):
+    return '{' + ', '.join(f'"{prefix}_{i}": {v!r}' for i, v in enumerate(values)) + '}'
+
+def gen_action_set(config, seed):
     if config["actionCount"] == -1:
         return None
-    all_actions = []
-    for i in range(0, config["actionCount"]):
-        all_actions.append(gen_action(config))
-    return all_actions
-
-def gen_decision(config, all_actions):
-    decision = dict()
-    c = dict()
-    decision["Version"] = "1"
-    decision["c"] = c
-
-    shared_ctx = dict()
-    for i in range(0, config["sharedCount"]):
-        shared_ctx[f'c_{i}'] = random.random()
-    c["TShared"] = shared_ctx
-    
-    actions = set()
-    action_list = []
-    while len(action_list) < config["actionsPerDecision"]:
-        if all_actions == None:
-            action_list.append(gen_action(config))
-        else:
-            idx = random.randint(0, len(all_actions) - 1)
-            if not (idx in actions):
-                actions.add(idx)
-                action_list.append(all_actions[idx])
+    rng = np.random.default_rng([seed, 0])
+    features = rng.random((config["actionCount"], config["featuresPerAction"]))
+    return [format_features('f', row) for row in features.tolist()]
+
+def popularity_weights(config):
+    n = config["actionCount"]
+    if config["popularity"] == "uniform":
+        return np.zeros(n)
+    # log of the zipf weight of each rank
+    return -config["zipfExponent"] * np.log(np.arange(1, n + 1))
 
-    c["_multi"] = action_list
-    return json.dumps(decision)
+# picks actionsPerDecision distinct actions for each decision with a gumbel top-k over the log
+# weights, which samples without replacement proportionally to the weights
+def pick_actions(config, rng, first_decision, count, log_weights, rank_to_action):
+    n = config["actionCount"]
+    k = config["actionsPerDecision"]
+    keys = log_weights + rng.gumbel(size=(count, n))
+    ranks = np.argpartition(-keys, k - 1, axis=1)[:, :k]
+    # keep the popularity order within each decision
+    ranks = np.take_along_axis(ranks, np.argsort(np.take_along_axis(-keys, ranks, axis=1), axis=1), axis=1)
+    if config["popularity"] == "drift":
+        # the hot set slides across the actions as the log goes on
+        shift = (np.arange(first_decision, first_decision + count) * config["driftRate"]).astype(np.int64)
+        return rank_to_action[(ranks + shift[:, None]) % n]
+    return rank_to_action[ranks]
 
+def gen_chunk(task):
+    config, seed, chunk, first_decision, count, all_actions = task
+    rng = np.random.default_rng([seed, 1, chunk])
+    shared = rng.random((count, config["sharedCount"])).tolist()
+    if all_actions == None:
+        features = rng.random((count, config["actionsPerDecision"], config["featuresPerAction"])).tolist()
+        multis = [[format_features('f', a) for a in d] for d in features]
+    else:
+        # popularity rank -> action, fixed for the whole log
+        rank_to_action = np.random.default_rng([seed, 2]).permutation(config["actionCount"])
+        picks = pick_actions(config, rng, first_decision, count, popularity_weights(config), rank_to_action)
+        multis = [[all_actions[i] for i in d] for d in picks.tolist()]
 
-def gen_log(name, config):
-    all_actions = gen_action_set(config)
+    lines = []
+    for shared_ctx, multi in zip(shared, multis):
+        lines.append(f'{{"Version": "1", "c": {{"TShared": {format_features("c", shared_ctx)}, "_multi": [{", ".join(multi)}]}}}}\n')
+    return ''.join(lines)
+
+def gen_log(name, config, seed, jobs):
+    all_actions = gen_action_set(config, seed)
+    tasks = []
+    for chunk, first in enumerate(range(0, config["decisionCount"], CHUNK_DECISIONS)):
+        count = min(CHUNK_DECISIONS, config["decisionCount"] - first)
+        tasks.append((config, seed, chunk, first, count, all_actions))
     with open(name, 'w+') as res:
-        for j in range(0, config["decisionCount"]):
-            res.write(gen_decision(config, all_actions))
-            res.write( "\n")
+        if jobs > 1:
+            with multiprocessing.Pool(jobs) as pool:
+                for text in pool.imap(gen_chunk, tasks):
+                    res.write(text)
+        else:
+            for task in tasks:
+                res.write(gen_chunk(task))
 
 
 parser = argparse.ArgumentParser(description="Log generation")
 parser.add_argument('--name', help='Name to use for the logs')
 parser.add_argument('--set1', help='Generate 100,200,600,1000 batch of actions', action='store_true')
 parser.add_argument('--extreme', help='Generate batch with near to no action overlap', action='store_true')
+parser.add_argument('--decisions', type=int, help=f'Decisions per log (default {default_config["decisionCount"]})', default=default_config["decisionCount"])
+parser.add_argument('--popularity', choices=['uniform', 'zipf', 'drift'], default=default_config["popularity"],
+    help='How actions are picked: uniformly, zipf by a fixed rank, or zipf with the popular actions drifting over time (default uniform)')
+parser.add_argument('--zipf-s', type=float, help=f'Zipf exponent (default {default_config["zipfExponent"]})', default=default_config["zipfExponent"])
+parser.add_argument('--drift', type=float, help=f'Ranks the popularity shifts by per decision with --popularity drift (default {default_config["driftRate"]})', default=default_config["driftRate"])
+parser.add_argument('--seed', type=int, help='Seed, the same seed and options always give the same logs (default random)', default=None)
+parser.add_argument('--jobs', '-j', type=int, help='Worker processes formatting chunks of the log (default 1)', default=1)
 
 args = parser.parse_args()
 
+if __name__ == '__main__':
+    seed = args.seed
+    if seed == None:
+        seed = int(np.random.SeedSequence().entropy % (2 ** 32))
+        print(f'seed: {seed}')
+
+    base_config = dict(default_config)
+    base_config["decisionCount"] = args.decisions
+    base_config["popularity"] = args.popularity
+    base_config["zipfExponent"] = args.zipf_s
+    base_config["driftRate"] = args.drift
 
-if args.set1:
-    for actions in [100, 200, 600, 1000]:
-        config = dict(default_config)
-        config["actionCount"] = actions
-        gen_log(f'{args.name}_{actions}.in', config)
-if args.extreme:
-        config = dict(default_config)
-        config["actionCount"] = -1
-        gen_log(f'{args.name}.in', config)
+    if args.set1:
+        for actions in [100, 200, 600, 1000]:
+            config = dict(base_config)
+            config["actionCount"] = actions
+            gen_log(f'{args.name}_{actions}.in', config, seed, args.jobs)
+    if args.extreme:
+            config = dict(base_config)
+            config["actionCount"] = -1
+            gen_log(f'{args.name}.in', config, seed, args.jobs)
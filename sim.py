@@ -1,12 +1,552 @@
 import argparse;
-import numpy as np;
 import zlib;
-import zstandard as zstd;
-import brotli;
-import snappy;
 import json;
+import os;
+import time;
+import math;
+import io;
 import random;
-from tqdm import tqdm;
+import bisect;
+import itertools;
+import collections;
+import datetime;
+import hashlib;
+import sys;
+import importlib.util;
+
+# Modules that only some algorithms or modes need are imported the first time they are used, so a
+# run only pays for what it picked. numpy alone takes longer to import than a short zlib run, and
+# the default report doesn't need it. Returns None if the module isn't installed, see AlgoSpec.requires
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec == None:
+        return None
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+zstd = lazy_import('zstandard')
+brotli = lazy_import('brotli')
+snappy = lazy_import('snappy')
+metadata = lazy_import('importlib.metadata')
+np = lazy_import('numpy')
+futures = lazy_import('concurrent.futures')
+multiprocessing = lazy_import('multiprocessing')
+gzip = lazy_import('gzip')
+mmap = lazy_import('mmap')
+pickle = lazy_import('pickle')
+
+def mean(values):
+    return sum(values) / len(values)
+
+# progress bars only on a terminal, scripted runs skip them and importing tqdm
+def progress_bar(iterable, **kwargs):
+    if not sys.stderr.isatty():
+        return iterable
+    from tqdm import tqdm
+    return tqdm(iterable, **kwargs)
+
+# Fixed width id of an action's canonical text. Dedup dicts and counters are keyed by it so they
+# neither hold nor hash the text of every action they see, the text is only kept for dict entries.
+def action_fingerprint(text):
+    return int.from_bytes(hashlib.blake2b(bytes(text, 'utf-8'), digest_size=FINGERPRINT_BYTES).digest(), 'little')
+
+# seconds since the epoch from a numeric or ISO 8601 event timestamp
+def parse_timestamp(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    ts = datetime.datetime.fromisoformat(value)
+    if ts.tzinfo == None:
+        ts = ts.replace(tzinfo=datetime.timezone.utc)
+    return ts.timestamp()
+
+# Parse-once view of an event shared by all processors of a client.
+# The canonical dump is json.dumps(event) split around the _multi list, so a processor can rebuild
+# the transformed event by splicing action texts without touching the rest of the event again.
+class ParsedEvent:
+    MULTI_MARK = '__multi_placeholder__'
+
+    def __init__(self, data):
+        evt = json.loads(data)
+        self.event = evt
+        self.actions = evt["c"]["_multi"]
+        # canonical action keys, same as json.dumps(action)
+        self.action_keys = [json.dumps(action) for action in self.actions]
+        self.action_fps = [action_fingerprint(k) for k in self.action_keys]
+
+        evt["c"]["_multi"] = ParsedEvent.MULTI_MARK
+        self.prefix, self.suffix = json.dumps(evt).split(json.dumps(ParsedEvent.MULTI_MARK), 1)
+        evt["c"]["_multi"] = self.actions
+
+    # actions_text has one json text per action, in the original order
+    def render(self, actions_text):
+        return f'{self.prefix}[{", ".join(actions_text)}]{self.suffix}'
+
+# Reusable zstd compression contexts keyed by level and dictionary identity.
+# Building a ZstdCompressor per line is a big share of the per-line cost, and with a dictionary it
+# would also digest the dictionary every time. Dictionaries are digested once (precompute_compress)
+# and must be dropped when the owner retrains them.
+class ZstdCompressorCache:
+    def __init__(self):
+        self.compressors = dict()
+
+    def get(self, level, zdict=None):
+        key = (level, id(zdict))
+        entry = self.compressors.get(key)
+        if entry == None:
+            if zdict == None:
+                compressor = zstd.ZstdCompressor(level=level)
+            else:
+                zdict.precompute_compress(level=level)
+                compressor = zstd.ZstdCompressor(level=level, dict_data=zdict)
+            # keep a reference to the dict so its id can't be reused while the entry lives
+            entry = (compressor, zdict)
+            self.compressors[key] = entry
+        return entry[0]
+
+    def drop(self, zdict):
+        if zdict == None:
+            return
+        for key in [k for k in self.compressors if k[1] == id(zdict)]:
+            del self.compressors[key]
+
+zstd_contexts = ZstdCompressorCache()
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def varint_size(value):
+    return max(1, (value.bit_length() + 6) // 7)
+
+def read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            return value, pos
+        shift += 7
+
+# Wire format of a batch:
+#   magic 'ESB1' | varint section count | sections
+#   section: kind u8 | codec u8 | flags u8 | varint payload length | payload
+# Dictionary sections apply to every event of the batch regardless of where they show up.
+WIRE_MAGIC = b'ESB1'
+SECTION_ZDICT = 1 # zstd dictionary
+SECTION_DEDUP = 2 # dedup dictionary, json object of action -> id
+SECTION_EVENT = 3
+SECTION_DEDUP_DELTA = 4 # changes to a dedup dict kept across batches, json {"add": {action: id}, "evict": [id]}
+SECTION_EVENT_STREAM = 5 # all events of the batch compressed as one stream, newline separated
+SECTION_COLUMNAR = 6 # all events of the batch with the float actions in a binary matrix, see encode_columnar
+SECTION_EVENT_REFS = 7 # dedup event in binary framing, see encode_refs_event
+FLAG_ZDICT = 1 # payload was compressed with the batch zstd dictionary
+FLAG_SHUFFLE = 2 # columnar floats are byte shuffled
+
+CODEC_RAW = 0
+CODEC_ZSTD = 1
+CODEC_ZLIB = 2
+CODEC_BROTLI = 3
+CODEC_SNAPPY = 4
+
+def encode_batch(sections):
+    out = bytearray(WIRE_MAGIC)
+    write_varint(out, len(sections))
+    for kind, codec, flags, payload in sections:
+        out.append(kind)
+        out.append(codec)
+        out.append(flags)
+        write_varint(out, len(payload))
+        out += payload
+    return bytes(out)
+
+def decompress_section(codec, payload, zdecompressor):
+    if codec == CODEC_RAW:
+        return payload
+    if codec == CODEC_ZSTD:
+        return zdecompressor.decompress(payload)
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(payload)
+    if codec == CODEC_BROTLI:
+        return brotli.decompress(payload)
+    if codec == CODEC_SNAPPY:
+        return snappy.decompress(payload)
+    raise Exception(f'unknown codec {codec}')
+
+# Columnar layout of a batch, each block is varint length | bytes:
+#   schema: json list of the feature names of the columnar actions
+#   texts: per event its canonical dump around the actions (prefix \x1f suffix), newline separated
+#   counts: actions per event, u16
+#   kinds: per action 0 if it's in the float matrix, 1 if it's in the other actions block
+#   other: json text of the actions that don't fit the schema, newline separated
+#   floats: float64 matrix one action per row, optionally byte shuffled (all the 1st bytes, then all
+#           the 2nd bytes...) which groups the similar sign/exponent bytes together. Rows and not
+#           feature columns as a repeated action is then one long match for zstd
+def is_columnar(action, schema):
+    return isinstance(action, dict) and list(action.keys()) == schema and all(type(v) == float for v in action.values())
+
+# the feature names of the first all float action, None if there is none
+def columnar_schema(events):
+    for evt in events:
+        for action in evt.actions:
+            if isinstance(action, dict) and len(action) > 0 and all(type(v) == float for v in action.values()):
+                return list(action.keys())
+    return None
+
+def encode_columnar(events, shuffle):
+    schema = columnar_schema(events) or []
+
+    kinds = []
+    rows = []
+    other = []
+    for evt in events:
+        for action, key in zip(evt.actions, evt.action_keys):
+            if is_columnar(action, schema):
+                kinds.append(0)
+                rows.append(list(action.values()))
+            else:
+                kinds.append(1)
+                other.append(key)
+    floats = np.array(rows, dtype='<f8').reshape(len(rows), len(schema)).tobytes()
+    if shuffle:
+        floats = np.frombuffer(floats, dtype=np.uint8).reshape(-1, 8).T.tobytes()
+
+    blocks = [
+        bytes(json.dumps(schema), 'utf-8'),
+        bytes('\n'.join(f'{evt.prefix}\x1f{evt.suffix}' for evt in events), 'utf-8'),
+        np.array([len(evt.actions) for evt in events], dtype='<u2').tobytes(),
+        bytes(kinds),
+        bytes('\n'.join(other), 'utf-8'),
+        floats,
+    ]
+    out = bytearray()
+    for b in blocks:
+        write_varint(out, len(b))
+        out += b
+    return bytes(out)
+
+def decode_columnar(data, shuffle):
+    blocks = []
+    pos = 0
+    while pos < len(data):
+        length, pos = read_varint(data, pos)
+        blocks.append(data[pos:pos + length])
+        pos += length
+    schema_text, texts, counts, kinds, other, floats = blocks
+    schema = json.loads(schema_text)
+    if shuffle:
+        floats = np.frombuffer(floats, dtype=np.uint8).reshape(8, -1).T.tobytes()
+    n_rows = len(floats) // 8 // len(schema) if len(schema) > 0 else 0
+    rows = np.frombuffer(floats, dtype='<f8').reshape(n_rows, len(schema)).tolist()
+    other = str(other, 'utf-8').split('\n')
+
+    lines = []
+    row = 0
+    next_other = 0
+    action = 0
+    for text, count in zip(str(texts, 'utf-8').split('\n'), np.frombuffer(counts, dtype='<u2').tolist()):
+        prefix, suffix = text.split('\x1f')
+        actions = []
+        for i in range(0, count):
+            if kinds[action] == 0:
+                actions.append(json.dumps(dict(zip(schema, rows[row]))))
+                row += 1
+            else:
+                actions.append(other[next_other])
+                next_other += 1
+            action += 1
+        lines.append(bytes(f'{prefix}[{", ".join(actions)}]{suffix}', 'utf-8'))
+    return lines
+
+# Binary framing of a dedup event, refs are varints instead of {"__idx": id} json:
+#   varint len | prefix | varint len | suffix | varint action count | per action either
+#   varint id + 1 for a ref, or varint 0 | varint len | json text of the action
+def encode_refs_event(event, items):
+    out = bytearray()
+    for text in [event.prefix, event.suffix]:
+        b = bytes(text, 'utf-8')
+        write_varint(out, len(b))
+        out += b
+    write_varint(out, len(items))
+    for item in items:
+        if isinstance(item, int):
+            write_varint(out, item + 1)
+        else:
+            b = bytes(item, 'utf-8')
+            write_varint(out, 0)
+            write_varint(out, len(b))
+            out += b
+    return bytes(out)
+
+def decode_refs_event(data, dedup):
+    texts = []
+    pos = 0
+    for i in range(0, 2):
+        length, pos = read_varint(data, pos)
+        texts.append(str(data[pos:pos + length], 'utf-8'))
+        pos += length
+    count, pos = read_varint(data, pos)
+    actions = []
+    for i in range(0, count):
+        tag, pos = read_varint(data, pos)
+        if tag > 0:
+            actions.append(dedup[tag - 1])
+            continue
+        length, pos = read_varint(data, pos)
+        actions.append(str(data[pos:pos + length], 'utf-8'))
+        pos += length
+    return bytes(f'{texts[0]}[{", ".join(actions)}]{texts[1]}', 'utf-8')
+
+# Rebuilds the original events of a batch. This is what the ingest tier has to do, so it's what we time.
+# state holds what the server keeps across batches of the same stream.
+def decode_batch(data, state):
+    if data[:4] != WIRE_MAGIC:
+        raise Exception('bad batch magic')
+    count, pos = read_varint(data, 4)
+    sections = []
+    for i in range(0, count):
+        kind, codec, flags = data[pos], data[pos + 1], data[pos + 2]
+        length, pos = read_varint(data, pos + 3)
+        sections.append((kind, codec, flags, data[pos:pos + length]))
+        pos += length
+
+    plain = zstd.ZstdDecompressor()
+    with_dict = None
+    for kind, codec, flags, payload in sections:
+        if kind == SECTION_ZDICT:
+            zdict = zstd.ZstdCompressionDict(decompress_section(codec, payload, plain))
+            with_dict = zstd.ZstdDecompressor(dict_data=zdict)
+
+    dedup = None
+    evictions = []
+    for kind, codec, flags, payload in sections:
+        if kind == SECTION_DEDUP:
+            text = decompress_section(codec, payload, with_dict if flags & FLAG_ZDICT else plain)
+            dedup = dict((v, k) for k, v in json.loads(text).items())
+        elif kind == SECTION_DEDUP_DELTA:
+            delta = json.loads(decompress_section(codec, payload, with_dict if flags & FLAG_ZDICT else plain))
+            # the client restarted or we missed a delta, the batch carries the whole dict
+            if delta.get('reset', False):
+                state['dedup'] = dict()
+            dedup = state.setdefault('dedup', dict())
+            for k, v in delta['add'].items():
+                dedup[v] = k
+            # entries can be added and evicted in the same batch, so evict after decoding
+            evictions = delta['evict']
+
+    lines = []
+    for kind, codec, flags, payload in sections:
+        if kind == SECTION_EVENT_STREAM:
+            # streamed zstd frames don't carry their content size
+            if codec == CODEC_ZSTD:
+                data = (with_dict if flags & FLAG_ZDICT else plain).decompressobj().decompress(payload)
+            else:
+                data = decompress_section(codec, payload, None)
+            lines.extend(io.BytesIO(data).readlines())
+        if kind == SECTION_COLUMNAR:
+            lines.extend(decode_columnar(decompress_section(codec, payload, plain), flags & FLAG_SHUFFLE))
+        if kind == SECTION_EVENT_REFS:
+            lines.append(decode_refs_event(decompress_section(codec, payload, with_dict if flags & FLAG_ZDICT else plain), dedup))
+        if kind != SECTION_EVENT:
+            continue
+        line = decompress_section(codec, payload, with_dict if flags & FLAG_ZDICT else plain)
+        if dedup != None:
+            evt = ParsedEvent(line)
+            actions = []
+            for action, key in zip(evt.actions, evt.action_keys):
+                if isinstance(action, dict) and len(action) == 1 and '__idx' in action:
+                    actions.append(dedup[action['__idx']])
+                else:
+                    actions.append(key)
+            line = bytes(evt.render(actions), 'utf-8')
+        lines.append(line)
+
+    for action_id in evictions:
+        del dedup[action_id]
+    return lines
+
+# Collects the sections a processor emits for the current batch, then encodes, decodes and checks it
+# against the original lines when the batch closes.
+class WireBatchWriter:
+    def __init__(self):
+        self.sections = []
+        self.line_sections = []
+        self.lines = []
+        self.decoder_state = dict()
+        # wire-size, raw-size, events, decode-secs, errors
+        self.batches = []
+
+    def add_section(self, kind, codec, flags, payload):
+        if kind == SECTION_EVENT or kind == SECTION_EVENT_REFS:
+            self.line_sections.append((kind, codec, flags, payload))
+        else:
+            self.sections.append((kind, codec, flags, payload))
+
+    # a line can be processed twice on overflow, only the last attempt makes it to the wire
+    def start_line(self):
+        self.line_sections = []
+
+    def commit_line(self, line):
+        self.sections.extend(self.line_sections)
+        self.line_sections = []
+        self.lines.append(line)
+
+    # a dropped batch never reaches the server, so there is nothing to decode
+    def finish_batch(self, dropped=False):
+        if dropped:
+            self.sections = []
+            self.lines = []
+            return
+        data = encode_batch(self.sections)
+        start = time.perf_counter()
+        try:
+            decoded = decode_batch(data, self.decoder_state)
+        except Exception:
+            decoded = []
+        decode_secs = time.perf_counter() - start
+
+        errors = abs(len(decoded) - len(self.lines))
+        for orig, line in zip(self.lines, decoded):
+            orig = bytes(orig).rstrip(b'\n')
+            line = line.rstrip(b'\n')
+            if orig != line and json.loads(orig) != json.loads(line):
+                errors += 1
+
+        raw_size = sum(len(l) for l in self.lines)
+        self.batches.append([len(data), raw_size, len(decoded), decode_secs, errors])
+        self.sections = []
+        self.lines = []
+
+# Log-bucketed histogram (~5% error per bucket) so we can keep one per processor for every line
+# without storing samples, and merge/pickle it cheaply.
+class Histogram:
+    GROWTH = 1.05
+
+    def __init__(self):
+        self.buckets = dict()
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        idx = int(math.log(value, Histogram.GROWTH)) if value > 1 else 0
+        self.buckets[idx] = self.buckets.get(idx, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0
+        target = p / 100 * self.count
+        seen = 0
+        for idx in sorted(self.buckets):
+            seen += self.buckets[idx]
+            if seen >= target:
+                return min(Histogram.GROWTH ** (idx + 1), self.max)
+        return self.max
+
+    # p50, p99, max
+    def summary(self, scale=1):
+        return self.percentile(50) / scale, self.percentile(99) / scale, self.max / scale
+
+# CPU time spent by a processor: per line (process), at batch boundaries (on_batch_end, dict training
+# in batch_done, on_batch_start) and per whole batch. All in thread CPU ns.
+class ProcessorTiming:
+    def __init__(self):
+        self.line = Histogram()
+        self.boundary = Histogram()
+        self.batch = Histogram()
+        self.cur_batch = 0
+
+    def add_line(self, ns):
+        self.line.add(ns)
+        self.cur_batch += ns
+
+    def add_boundary(self, ns):
+        self.boundary.add(ns)
+        self.batch.add(self.cur_batch + ns)
+        self.cur_batch = 0
+
+    def total_secs(self):
+        return (self.line.total + self.boundary.total) / 1_000_000_000
+
+train_executor = None
+
+def get_train_executor():
+    global train_executor
+    if train_executor == None:
+        train_executor = futures.ThreadPoolExecutor(max_workers=args.train_threads)
+    return train_executor
+
+# zstd refuses to train on too little data, which small (deadline flushed) batches often are.
+# Returns None then and the caller keeps the dict it has
+def train_zdict(dict_size, samples):
+    try:
+        return zstd.train_dictionary(dict_size, samples)
+    except zstd.ZstdError as e:
+        if 'Src size is incorrect' not in str(e):
+            raise
+        return None
+
+def train_in_background(dict_size, samples, batch_index):
+    return train_zdict(dict_size, samples), batch_index
+
+# Retrains a zstd dictionary at batch boundaries. Inline by default; in async mode training runs on
+# a background thread while the next batch keeps compressing with the old dict, and the new one is
+# swapped in at the first boundary after it's ready. Batches closing while a training is in flight
+# don't start another one.
+class DictTrainer:
+    def __init__(self, dict_size):
+        self.dict_size = dict_size
+        self.future = None
+        self.cur_dict = None
+        self.cur_dict_batch = None
+        # per batch using a dict: how many batches ago its training data closed (1 is fresh)
+        self.staleness = []
+        # trainings zstd refused for too little data, the old dict (if any) stayed in use
+        self.failed_trainings = 0
+
+    # called when batch_index closed, returns the dict to use for the next batch
+    def retrain(self, samples, batch_index, async_train):
+        if not async_train:
+            new_dict = train_zdict(self.dict_size, samples)
+            if new_dict != None:
+                self.cur_dict = new_dict
+                self.cur_dict_batch = batch_index
+            else:
+                self.failed_trainings += 1
+        else:
+            if self.future != None and self.future.done():
+                new_dict, new_dict_batch = self.future.result()
+                if new_dict != None:
+                    self.cur_dict, self.cur_dict_batch = new_dict, new_dict_batch
+                else:
+                    self.failed_trainings += 1
+                self.future = None
+            if self.future == None:
+                self.future = get_train_executor().submit(train_in_background, self.dict_size, list(samples), batch_index)
+
+        if self.cur_dict_batch != None:
+            self.staleness.append(batch_index + 1 - self.cur_dict_batch)
+        return self.cur_dict
+
+    # a restarted client has no dict and nothing in flight
+    def reset(self):
+        self.future = None
+        self.cur_dict = None
+        self.cur_dict_batch = None
+
+# state_sizes kinds that belong to the batch being built rather than to what is kept across batches
+BATCH_PARTS = ['batch', 'lines', 'events', 'trial']
 
 class LineProcessor:
     def __init__(self, label, max_batch_size):
@@ -18,10 +558,128 @@ class LineProcessor:
         self.cur_batch_line_count = 0
         self.cur_batch_header_size = 0
         self.batches = []
+        self.wire = None
+        self.timing = ProcessorTiming()
+        # per batch boundary: bytes left unused, bytes the overflowing line went over by
+        self.boundary_stats = []
+        # overflowing lines processed again vs kept as they were for the next batch
+        self.reprocessed = 0
+        self.reused = 0
+        self.async_train = False
+        # set by processors that retrain a zstd dict at batch boundaries
+        self.trainer = None
+        # fault injection, see enable_faults. per batch: batches since the last start, restart or
+        # dropped batch (0 is cold), whether it got dropped, cpu ns
+        self.restart_every = 0
+        self.drop_every = 0
+        self.restarts = 0
+        self.since_start = 0
+        self.fault_stats = []
+        # with arrival times (see Client.arrival_time): arrival of the current line, arrivals of the
+        # lines not in a closed batch yet and how long each line waited for its batch to close, in us
+        self.now = None
+        self.arrivals = collections.deque()
+        self.delay = Histogram()
+        # batches close once their oldest line waited this many seconds (None only closes on size)
+        self.flush_after = None
+        self.deadline_flushes = 0
+        # bytes of state the processor held at its biggest, sampled at batch boundaries (see
+        # state_sizes), and what it was made of
+        self.peak_state = 0
+        self.peak_state_sizes = dict()
+        # with a budget: batches that went over it and bytes shed to fit it, see enable_memory_budget
+        self.memory_budget = None
+        self.shed_memory = False
+        self.over_budget = 0
+        self.shed_bytes = 0
+
+    def enable_async_train(self):
+        self.async_train = True
+        self.label = f'{self.label}-async'
+
+    # swaps in the trainer's dict for the next batch, dropping the contexts of the one it replaces
+    # zstd dict trainings that failed for too little data, None if the processor doesn't train any
+    def failed_trainings(self):
+        return self.trainer.failed_trainings if self.trainer != None else None
+
+    def retrain_zdict(self, cur_zdict, samples):
+        new_zdict = self.trainer.retrain(samples, len(self.batches) - 1, self.async_train)
+        if new_zdict is not cur_zdict:
+            zstd_contexts.drop(cur_zdict)
+        return new_zdict
+
+    # the client restarts after every restart_every batches, losing whatever the processor keeps
+    # across batches, and every drop_every batch is lost on the way to the server (0 never)
+    def enable_faults(self, restart_every, drop_every):
+        self.restart_every = restart_every
+        self.drop_every = drop_every
+        if restart_every > 0:
+            self.label = f'{self.label}-restart{restart_every}'
+        if drop_every > 0:
+            self.label = f'{self.label}-drop{drop_every}'
+
+    def faults_enabled(self):
+        return self.restart_every > 0 or self.drop_every > 0
+
+    # batches whose retained state goes over budget bytes are counted, and with shed the processor drops
+    # what it keeps across batches to fit before the next one starts. The batch being built (BATCH_PARTS)
+    # is not covered: it is bounded by --batch-size and only shows up in the peak
+    def enable_memory_budget(self, budget, shed):
+        self.memory_budget = budget
+        self.shed_memory = shed
+        if shed:
+            self.label = f'{self.label}-mem{budget}'
+
+    # Bytes of state held right now by kind: the compressed batch, buffered lines, training samples,
+    # dicts and counters. Counted as the payload a client would keep (texts, fingerprints, 4 byte ids
+    # and 8 byte counters), not python object overhead, and without the codec's own work memory.
+    def state_sizes(self):
+        return { 'batch': self.cur_batch_size }
+
+    # drops up to excess bytes of what is kept across batches, returns the bytes freed
+    def shed_state(self, excess):
+        return 0
+
+    def sample_state(self):
+        sizes = self.state_sizes()
+        total = sum(sizes.values())
+        if total > self.peak_state:
+            self.peak_state = total
+            self.peak_state_sizes = sizes
+        return sizes
+
+    def enable_deadline(self, flush_ms):
+        self.flush_after = flush_ms / 1000
+        self.label = f'{self.label}-flush{flush_ms:g}ms'
+
+    # called by the client with the arrival time of the next line, before add_bytes. A batch whose
+    # deadline went by while no lines came in got flushed by the timer at the deadline
+    def advance(self, now):
+        if self.flush_after != None and self.cur_batch_line_count > 0 and now - self.arrivals[0] >= self.flush_after:
+            self.flush()
+        self.now = now
+        self.arrivals.append(now)
+
+    # build real batches and decode them back, see WireBatchWriter
+    def enable_wire(self):
+        self.wire = WireBatchWriter()
+
+    # every compressed fragment goes through here so the wire writer sees it, returns its size
+    def emit(self, kind, codec, payload, flags=0):
+        if self.wire != None:
+            self.wire.add_section(kind, codec, flags, payload)
+        return len(payload)
 
     def process(self, data):
         raise Exception("missing method process")
 
+    # event is the ParsedEvent shared by the client, or None if nobody asked for it
+    def process_line(self, line, event):
+        return self.process(line)
+
+    def needs_parsed_event(self):
+        return False
+
     #called before anything item is processed
     def on_batch_start(self):
         pass
@@ -32,6 +690,19 @@ class LineProcessor:
 
     def reprocess_across_batches(self):
         return False
+
+    # called on a line that overflowed once the next batch has started. returns the size the first
+    # attempt still has in the new batch if it is valid as is, None to process the line again
+    def revalidate_overflow(self, line, event, item_size):
+        return None
+
+    # what the current batch and the line count for in the overflow check, see boundary_stats
+    def boundary_sizes(self, item_size):
+        return self.cur_batch_size, item_size
+
+    # called once the current line is part of the batch
+    def on_item_added(self):
+        pass
     
     def gen_specific_csv(self):
         return None
@@ -43,17 +714,64 @@ class LineProcessor:
         self.cur_batch_header_size += header_size
         self.cur_batch_size += header_size
     
+    # called after the batch was closed and before the next one starts
+    def on_batch_closed(self):
+        pass
+
+    # called instead of on_batch_closed when the client restarts, drop everything kept across batches
+    def on_restart(self):
+        pass
+
+    # called after on_batch_closed when the batch never made it to the server
+    def on_batch_dropped(self):
+        pass
+
     def finish_batch(self):
+        start = time.thread_time_ns()
         self.on_batch_end()
+        boundary_ns = time.thread_time_ns() - start
+        # the batch and its training data are at their biggest before the batch closes
+        self.sample_state()
+        n = len(self.batches) + 1
+        restart = self.restart_every > 0 and n % self.restart_every == 0
+        dropped = self.drop_every > 0 and n % self.drop_every == 0
+        if self.wire != None:
+            self.wire.finish_batch(dropped)
 
         self.batches.append([self.cur_batch_size, self.cur_batch_raw_size, self.cur_batch_line_count, self.cur_batch_header_size])
+        # the batch holds the oldest lines still waiting, the one that made it close may not be in it
+        if self.now != None:
+            for i in range(0, self.cur_batch_line_count):
+                self.delay.add(max(0, self.now - self.arrivals.popleft()) * 1_000_000)
 
         self.cur_batch_size = 0
         self.cur_batch_raw_size = 0
         self.cur_batch_line_count = 0
         self.cur_batch_header_size = 0
 
+        start = time.thread_time_ns()
+        if restart:
+            self.restarts += 1
+            self.on_restart()
+        else:
+            self.on_batch_closed()
+        if dropped:
+            self.on_batch_dropped()
+        boundary_ns += time.thread_time_ns() - start
+        # and what is kept for the next batch is known once it closed
+        sizes = self.sample_state()
+        kept = sum(v for k, v in sizes.items() if k not in BATCH_PARTS)
+        if self.memory_budget != None and kept > self.memory_budget:
+            self.over_budget += 1
+            if self.shed_memory:
+                self.shed_bytes += self.shed_state(kept - self.memory_budget)
+        start = time.thread_time_ns()
         self.on_batch_start()
+        boundary_ns += time.thread_time_ns() - start
+        if self.faults_enabled():
+            self.fault_stats.append([self.since_start, int(dropped), self.timing.cur_batch + boundary_ns])
+            self.since_start = 0 if restart or dropped else self.since_start + 1
+        self.timing.add_boundary(boundary_ns)
 
     def does_item_overflow(self, item_size, cur_size, max_size):
         return item_size + cur_size > max_size
@@ -61,30 +779,206 @@ class LineProcessor:
     def start(self):
         self.on_batch_start()
 
-    def add_bytes(self, line):
+    def add_bytes(self, line, event=None):
         original_len = len(line)
-        item_size = self.process(line)
+        if self.wire != None:
+            self.wire.start_line()
+        start = time.thread_time_ns()
+        item_size = self.process_line(line, event)
+        line_ns = time.thread_time_ns() - start
         if self.does_item_overflow(item_size, self.cur_batch_size, self.max_batch_size):
+            batch_size, line_size = self.boundary_sizes(item_size)
+            self.boundary_stats.append([self.max_batch_size - batch_size, batch_size + line_size - self.max_batch_size])
+            restarts = self.restarts
             self.finish_batch()
             if self.reprocess_across_batches():
-                item_size = self.process(line)
+                start = time.thread_time_ns()
+                # whatever the first attempt relied on is gone after a restart
+                reused_size = self.revalidate_overflow(line, event, item_size) if self.restarts == restarts else None
+                if reused_size != None:
+                    item_size = reused_size
+                    self.reused += 1
+                else:
+                    if self.wire != None:
+                        self.wire.start_line()
+                    item_size = self.process_line(line, event)
+                    self.reprocessed += 1
+                line_ns += time.thread_time_ns() - start
+        self.timing.add_line(line_ns)
+        if self.wire != None:
+            self.wire.commit_line(line)
+        self.on_item_added()
 
         self.cur_batch_size += item_size
         self.cur_batch_raw_size += original_len
         self.cur_batch_line_count += 1
 
+    # ends the current batch early if it has anything in it, at its deadline if it has one
+    def flush(self):
+        if self.cur_batch_line_count > 0:
+            if self.flush_after != None:
+                self.now = self.arrivals[0] + self.flush_after
+                self.deadline_flushes += 1
+            self.finish_batch()
+
+    def mean_ratio(self):
+        return mean([b[1] / b[0] for b in self.batches])
+
     def report(self):
         print(f'{self.label} batches:{len(self.batches)}')
+        if len(self.batches) == 0:
+            return
+        mean_ratio = self.mean_ratio()
+        print(f'\tmean-ratio: {mean_ratio:2.2f} mean-lines:{mean([b[2] for b in self.batches]):.1f} mean-header:{int(mean([b[3] for b in self.batches]))}')
+        if self.wire != None and len(self.wire.batches) > 0:
+            wire_ratio, decode_mb_s, decode_events_s, errors = self.wire_stats()
+            print(f'\twire-ratio: {wire_ratio:2.2f} decode: {decode_mb_s:.1f} MB/s {decode_events_s:.0f} events/s errors:{errors}')
+        t = self.timing
+        print('\tline-us p50:{:.1f} p99:{:.1f} max:{:.1f}'.format(*t.line.summary(1_000)), end='')
+        print(' boundary-ms p50:{:.2f} p99:{:.2f} max:{:.2f}'.format(*t.boundary.summary(1_000_000)), end='')
+        print(f' cpu-secs:{t.total_secs():.2f}')
+        if len(self.boundary_stats) > 0:
+            slack, overflow = (mean([b[i] for b in self.boundary_stats]) for i in (0, 1))
+            print(f'\tboundary mean-slack:{slack:.0f} mean-overflow:{overflow:.0f} reprocessed:{self.reprocessed} reused:{self.reused}')
+        if self.trainer != None and len(self.trainer.staleness) > 0:
+            print(f'\tdict-staleness mean:{np.mean(self.trainer.staleness):.2f} max:{np.max(self.trainer.staleness)}')
+        if self.failed_trainings() != None:
+            print(f'\tdict-trainings failed:{self.failed_trainings()}')
+        parts = ' '.join(f'{k}:{v / 1024:.1f}' for k, v in self.peak_state_sizes.items())
+        print(f'\tstate peak-kb:{self.peak_state / 1024:.1f} ({parts})', end='')
+        if self.memory_budget != None:
+            print(f' over-budget-batches:{self.over_budget} shed-kb:{self.shed_bytes / 1024:.1f}', end='')
+        print()
+        if arrivals_enabled():
+            print('\tdelay-ms p50:{:.1f} p99:{:.1f} max:{:.1f}'.format(*self.delay.summary(1_000)), end='')
+            print(f' deadline-flushes:{self.deadline_flushes}')
+        if self.faults_enabled():
+            restarts, drops, lost_lines, cold_ratio, warm_ratio, resync_bytes, resync_cpu_ms = self.fault_cost()
+            print(f'\tfaults restarts:{restarts} drops:{drops} lost-lines:{lost_lines} cold-ratio:{cold_ratio:2.2f} warm-ratio:{warm_ratio:2.2f}', end='')
+            print(f' resync-bytes:{resync_bytes:.0f} resync-cpu-ms:{resync_cpu_ms:.2f}')
+
+    # Batches within args.recovery_batches of a start, restart or dropped batch are cold: they go out
+    # with empty or freshly rebuilt dicts, or resend the whole dict to resync the server. What they cost is measured against the
+    # ratio and cpu per raw byte of the warm ones, dropped batches never arrived so they are in neither. A cold
+    # batch can come out cheaper than a warm one (no dict to ship yet), that counts as no cost.
+    def fault_cost(self):
         n = np.array(self.batches)
-        mean_ratio = np.mean(n[:,1] / n[:,0])
-        print(f'\tmean-ratio: {mean_ratio:2.2f} mean-lines:{np.mean(n[:,2]):.1f} mean-header:{int(np.mean(n[:,3]))}')
+        f = np.array(self.fault_stats)
+        dropped = f[:,1] == 1
+        cold = (f[:,0] < args.recovery_batches) & ~dropped
+        warm = (f[:,0] >= args.recovery_batches) & ~dropped
+        lost_lines = int(np.sum(n[dropped, 2]))
+        cold_ratio = np.sum(n[cold, 1]) / np.sum(n[cold, 0]) if np.any(cold) else 0
+        if not np.any(warm):
+            return self.restarts, int(np.sum(f[:,1])), lost_lines, cold_ratio, 0, 0, 0
+        warm_ratio = np.sum(n[warm, 1]) / np.sum(n[warm, 0])
+        warm_ns_per_byte = np.sum(f[warm, 2]) / np.sum(n[warm, 1])
+        resync_bytes = max(0, np.sum(n[cold, 0]) - np.sum(n[cold, 1]) / warm_ratio)
+        resync_cpu_ms = max(0, np.sum(f[cold, 2]) - np.sum(n[cold, 1]) * warm_ns_per_byte) / 1_000_000
+        return self.restarts, int(np.sum(f[:,1])), lost_lines, cold_ratio, warm_ratio, resync_bytes, resync_cpu_ms
+
+    def wire_stats(self):
+        w = np.array(self.wire.batches)
+        decode_secs = np.sum(w[:,3])
+        return np.sum(w[:,1]) / np.sum(w[:,0]), np.sum(w[:,1]) / decode_secs / 1_000_000, np.sum(w[:,2]) / decode_secs, int(np.sum(w[:,4]))
+
+    # optional columns common to all processors, written between the generic and the specific ones
+    def get_extra_header(self):
+        cols = ['line_us_p50,line_us_p99,line_us_max,boundary_us_p50,boundary_us_p99,boundary_us_max,batch_us_p50,batch_us_p99,batch_us_max,cpu_secs',
+                'boundary_mean_slack,boundary_mean_overflow,reprocessed_lines,reused_lines', 'peak_state_bytes,peak_state_parts', 'failed_dict_trainings']
+        if self.memory_budget != None:
+            cols.append('over_budget_batches,shed_bytes')
+        if self.wire != None:
+            cols.append('wire_ratio,decode_mb_s,decode_events_s,decode_errors')
+        if args.async_train != 'off':
+            cols.append('mean_dict_staleness,max_dict_staleness')
+        if arrivals_enabled():
+            cols.append('delay_ms_p50,delay_ms_p99,delay_ms_max,deadline_flushes')
+        if self.faults_enabled():
+            cols.append('restarts,drops,lost_lines,cold_ratio,warm_ratio,resync_bytes,resync_cpu_ms')
+        return ','.join(cols) if len(cols) > 0 else None
+
+    def gen_extra_csv(self):
+        t = self.timing
+        timings = t.line.summary(1_000) + t.boundary.summary(1_000) + t.batch.summary(1_000) + (t.total_secs(),)
+        cols = [','.join(str(x) for x in timings)]
+        if len(self.boundary_stats) > 0:
+            slack, overflow = (mean([b[i] for b in self.boundary_stats]) for i in (0, 1))
+            cols.append(f'{slack},{overflow},{self.reprocessed},{self.reused}')
+        else:
+            cols.append(f',,{self.reprocessed},{self.reused}')
+        cols.append(f'{self.peak_state},{";".join(f"{k}={v}" for k, v in self.peak_state_sizes.items())}')
+        cols.append(str(self.failed_trainings()) if self.failed_trainings() != None else '')
+        if self.memory_budget != None:
+            cols.append(f'{self.over_budget},{self.shed_bytes}')
+        if self.wire != None:
+            if len(self.wire.batches) > 0:
+                cols.append(','.join(str(x) for x in self.wire_stats()))
+            else:
+                cols.append(',,,')
+        if args.async_train != 'off':
+            if self.trainer != None and len(self.trainer.staleness) > 0:
+                cols.append(f'{np.mean(self.trainer.staleness)},{np.max(self.trainer.staleness)}')
+            else:
+                cols.append(',')
+        if arrivals_enabled():
+            cols.append(','.join(str(x) for x in self.delay.summary(1_000) + (self.deadline_flushes,)))
+        if self.faults_enabled():
+            cols.append(','.join(str(x) for x in self.fault_cost()))
+        return ','.join(cols) if len(cols) > 0 else None
+
+    # everything a worker process needs to ship back so gen_csv/report can run in the parent
+    def get_results(self):
+        res = { 'batches': self.batches, 'timing': self.timing, 'boundary_stats': self.boundary_stats,
+                'reprocessed': self.reprocessed, 'reused': self.reused, 'peak_state': self.peak_state,
+                'peak_state_sizes': self.peak_state_sizes, 'over_budget': self.over_budget, 'shed_bytes': self.shed_bytes }
+        if self.wire != None:
+            res['wire_batches'] = self.wire.batches
+        if self.trainer != None:
+            res['dict_staleness'] = self.trainer.staleness
+            res['failed_trainings'] = self.trainer.failed_trainings
+        if self.faults_enabled():
+            res['restarts'] = self.restarts
+            res['fault_stats'] = self.fault_stats
+        if arrivals_enabled():
+            res['delay'] = self.delay
+            res['deadline_flushes'] = self.deadline_flushes
+        return res
+
+    def set_results(self, results):
+        self.batches = results['batches']
+        self.timing = results['timing']
+        self.boundary_stats = results['boundary_stats']
+        self.reprocessed = results['reprocessed']
+        self.reused = results['reused']
+        self.peak_state = results['peak_state']
+        self.peak_state_sizes = results['peak_state_sizes']
+        self.over_budget = results['over_budget']
+        self.shed_bytes = results['shed_bytes']
+        if self.wire != None:
+            self.wire.batches = results['wire_batches']
+        if self.trainer != None:
+            self.trainer.staleness = results['dict_staleness']
+            self.trainer.failed_trainings = results['failed_trainings']
+        if self.faults_enabled():
+            self.restarts = results['restarts']
+            self.fault_stats = results['fault_stats']
+        if arrivals_enabled():
+            self.delay = results['delay']
+            self.deadline_flushes = results['deadline_flushes']
 
     def gen_csv(self, header, out_file):
-        n = np.array(self.batches)
+        # clients that never completed a batch have nothing to report
+        if len(self.batches) == 0:
+            return
         #label, n_batches, mean_ratio, mean_lines, mean_header, mean_size
-        generic_line = f'{self.label},{len(self.batches)},{np.mean(n[:,1] / n[:,0])},{np.mean(n[:,2])},{np.mean(n[:,3])},{np.mean(n[:,0])}'
+        mean_lines, mean_header, mean_size = (mean([b[i] for b in self.batches]) for i in (2, 3, 0))
+        generic_line = f'{self.label},{len(self.batches)},{self.mean_ratio()},{mean_lines},{mean_header},{mean_size}'
+        extra = self.gen_extra_csv()
         specific = self.gen_specific_csv()
         line = f'{header},{generic_line}'
+        if extra != None:
+            line = f'{line},{extra}'
         if specific != None:
             line = f'{line},{specific}'
         out_file.write(line)
@@ -96,8 +990,8 @@ class AccumulateBatch(LineProcessor):
         super().__init__(label, max_batch_size)
         self.batch_data = []
 
-    def add_bytes(self, line):
-        super().add_bytes(line)
+    def add_bytes(self, line, event=None):
+        super().add_bytes(line, event)
         self.batch_data.append(line)
 
     def batch_done(self, batch_lines):
@@ -106,38 +1000,142 @@ class AccumulateBatch(LineProcessor):
     def reprocess_across_batches(self):
         return True
 
-    def finish_batch(self):
-        super().finish_batch()
+    # retrain before on_batch_start so the header of the new batch is the dict its events use
+    def on_batch_closed(self):
         self.batch_done(self.batch_data)
         self.batch_data = []
 
+    def on_restart(self):
+        self.batch_data = []
+
 class Dedup(AccumulateBatch):
     def __init__(self, label, max_dict_size, max_batch_size):
-        super().__init__(f'dedup-{label}_{max_dict_size}', max_batch_size)
+        super().__init__(f'dedup-{label}_{max_dict_size}{"-varint" if args.refs == "varint" else ""}', max_batch_size)
         self.max_dict_size = max_dict_size
+        # events go out as json text or in the binary framing of encode_refs_event
+        self.event_kind = SECTION_EVENT_REFS if args.refs == 'varint' else SECTION_EVENT
+        # everything is keyed by action fingerprint. action_set holds fingerprint -> [count, text length]
+        # and the text of the entries we pick is only looked up in batch_events once the batch is done
         self.action_set = dict()
         self.cur_dict = dict()
+        self.dict_texts = dict()
+        # one past the highest id in cur_dict
+        self.next_id = 0
+        self.batch_events = []
+        # different actions with the same fingerprint, they are left out of the dict
+        self.collisions = 0
         self.hits = 0
         self.misses = 0
         self.dedup_batch_stats = []
+        # what the last attempt at a line saw and wants to add, committed in on_item_added so a
+        # line processed again after an overflow is only counted once
+        self.line_event = None
+        self.line_hits = []
+        self.line_misses = 0
+        self.line_collisions = 0
+        self.pending_actions = []
 
     def get_header(self):
-        return 'mean-dict-lines,mean-dict-hit-ratio,mean-action-hit-ratio'
+        return 'mean-dict-lines,mean-dict-hit-ratio,mean-action-hit-ratio,fp-collisions'
 
-    def register_new_action(self, action, json_action):
+    # returns what to emit in place of the action, the id of a ref or the action json text
+    def register_new_action(self, fp, action, json_action):
        raise Exception("must override")
 
+    # ids are small ints counting up from 0 so refs stay short, see the subclasses for reuse.
+    # Entries can come in with ids of their own (a reused overflowing line), so count from the highest
+    def new_action_id(self):
+        return self.next_id + len(self.pending_actions)
+
+    def ref_text(self, action_id):
+        return json.dumps({ '__idx': action_id })
+
+    # bytes a ref takes in an event with the --refs encoding in use
+    def ref_size(self, action_id):
+        if self.event_kind == SECTION_EVENT_REFS:
+            return varint_size(action_id + 1)
+        return len(self.ref_text(action_id))
+
+    # items has per action either the id of a ref or the action json text
+    def encode_event(self, event, items):
+        if self.event_kind == SECTION_EVENT_REFS:
+            return encode_refs_event(event, items)
+        return bytes(event.render([self.ref_text(i) if isinstance(i, int) else i for i in items]), 'utf-8')
+
+    def on_dict_hit(self, fp):
+        pass
+
+    def add_dict_entry(self, fp, action, action_id):
+        self.cur_dict[fp] = action_id
+        self.dict_texts[fp] = action
+        self.next_id = max(self.next_id, action_id + 1)
+
+    def remove_dict_entry(self, fp):
+        del self.dict_texts[fp]
+        return self.cur_dict.pop(fp)
+
+    # the dict as the server sees it, action text -> id
+    def dict_dump(self):
+        return json.dumps(dict((self.dict_texts[fp], action_id) for fp, action_id in self.cur_dict.items()))
+
+    def on_item_added(self):
+        self.hits += len(self.line_hits)
+        self.misses += self.line_misses
+        self.collisions += self.line_collisions
+        for fp in self.line_hits:
+            self.on_dict_hit(fp)
+        if self.build_dict_from_prev_batch():
+            for fp, x in zip(self.line_event.action_fps, self.line_event.action_keys):
+                if fp in self.action_set:
+                    self.action_set[fp][0] += 1
+                else:
+                    self.action_set[fp] = [1, len(x)]
+            self.batch_events.append(self.line_event)
+        for fp, action, action_id in self.pending_actions:
+            self.add_dict_entry(fp, action, action_id)
+        self.line_event = None
+        self.line_hits = []
+        self.line_misses = 0
+        self.line_collisions = 0
+        self.pending_actions = []
+
+    def report(self):
+        super().report()
+        if self.collisions > 0:
+            print(f'\tfingerprint collisions:{self.collisions}')
+
+    def needs_parsed_event(self):
+        return True
+
     def build_dict_from_prev_batch(self):
         return True
 
+    # size budget of the next dict, log_line holds the stats of the dict just used or None if there was none
+    def next_dict_size(self, log_line):
+        return self.max_dict_size
+
     def gen_specific_csv(self):
         # mean-dict-lines, mean-dict-hit-ratio, mean-action-hit-ratio
+        # the first batch never has stats as it has no dict to use
+        if len(self.dedup_batch_stats) == 0:
+            return f',,,{self.collisions}'
         n = np.array(self.dedup_batch_stats)
         mean_dict_lines = np.mean(n[:,0])
         mean_dict_hit_ratio = np.mean(n[:,1] / n[:,0])
         mean_action_hit_ratio = np.mean(n[:,2] / (n[:,2] + n[:,3]))
 
-        return f'{mean_dict_lines},{mean_dict_hit_ratio},{mean_action_hit_ratio}'
+        return f'{mean_dict_lines},{mean_dict_hit_ratio},{mean_action_hit_ratio},{self.collisions}'
+
+    def get_results(self):
+        res = super().get_results()
+        res['dedup_batch_stats'] = self.dedup_batch_stats
+        res['collisions'] = self.collisions
+        return res
+
+    def set_results(self, results):
+        super().set_results(results)
+        self.dedup_batch_stats = results['dedup_batch_stats']
+        self.collisions = results['collisions']
 
     def batch_done(self, batch_lines):
         if self.build_dict_from_prev_batch() == False:
@@ -146,16 +1144,19 @@ class Dedup(AccumulateBatch):
             self.dedup_batch_stats.append(log_line)
             self.hits = self.misses = 0
             self.cur_dict = dict()
+            self.dict_texts = dict()
+            self.next_id = 0
             return
 
         # this is called after the batch is done
         lst = list(self.action_set.items())
-        lst.sort(key=lambda x: x[1] * len(x[0]), reverse=True)
+        lst.sort(key=lambda x: x[1][0] * x[1][1], reverse=True)
         final_dict = dict()
         total_len = 0
         actions = 0
 
         # don't record stats for first batch as it won't have a dict
+        log_line = None
         if len(self.cur_dict) > 0:
             found_actions = set(self.action_set.keys())
             used_entries = 0
@@ -166,86 +1167,180 @@ class Dedup(AccumulateBatch):
             log_line = [len(self.cur_dict), used_entries, self.hits, self.misses]
             self.dedup_batch_stats.append(log_line)
 
+        dict_size = self.next_dict_size(log_line)
         for kv in lst:
-            if total_len >= self.max_dict_size:
+            if total_len >= dict_size:
                 break
-            final_dict[kv[0]] = f'id_{random.randint(0, 1_000_000_000)}'
-            total_len += len(kv[0])
+            final_dict[kv[0]] = None
+            total_len += kv[1][1]
             actions += 1
+        # entries already in the dict keep their id, new ones get the lowest free ones
+        used = set(self.cur_dict[fp] for fp in final_dict if fp in self.cur_dict)
+        free_ids = (i for i in itertools.count() if i not in used)
+        for fp in final_dict:
+            final_dict[fp] = self.cur_dict[fp] if fp in self.cur_dict else next(free_ids)
+
+        final_texts = dict()
+        colliding = set()
+        for evt in self.batch_events:
+            for fp, x in zip(evt.action_fps, evt.action_keys):
+                if fp not in final_dict:
+                    continue
+                if fp not in final_texts:
+                    final_texts[fp] = x
+                elif final_texts[fp] != x and fp not in colliding:
+                    colliding.add(fp)
+                    self.collisions += 1
+        for fp in colliding:
+            del final_dict[fp]
+            del final_texts[fp]
 
         self.cur_dict = final_dict
+        self.dict_texts = final_texts
+        self.next_id = max(final_dict.values(), default=-1) + 1
         self.action_set = dict()
+        self.batch_events = []
+        self.hits = self.misses = 0
+
+    def on_restart(self):
+        super().on_restart()
+        self.action_set = dict()
+        self.cur_dict = dict()
+        self.dict_texts = dict()
+        self.next_id = 0
+        self.batch_events = []
         self.hits = self.misses = 0
 
+    # dict entries are fingerprint, id and text, counters a fingerprint and two ints
+    def state_sizes(self):
+        sizes = super().state_sizes()
+        sizes['dict'] = sum(FINGERPRINT_BYTES + 4 + len(x) for x in self.dict_texts.values())
+        sizes['counters'] = len(self.action_set) * (FINGERPRINT_BYTES + 8)
+        sizes['events'] = sum(len(evt.prefix) + len(evt.suffix) + sum(len(x) for x in evt.action_keys) for evt in self.batch_events)
+        return sizes
+
+    # the dict built from the previous batch is ordered best first, so shed from the end
+    def shed_state(self, excess):
+        shed = 0
+        if not self.build_dict_from_prev_batch():
+            return shed
+        while shed < excess and len(self.cur_dict) > 0:
+            fp = next(reversed(self.cur_dict))
+            shed += FINGERPRINT_BYTES + 4 + len(self.dict_texts[fp])
+            self.remove_dict_entry(fp)
+        return shed
+
     def on_batch_start(self):
         if len(self.cur_dict) > 0 and self.build_dict_from_prev_batch():
-            self.add_header_bytes(self.process_header(json.dumps(self.cur_dict)))
+            self.add_header_bytes(self.process_header(self.dict_dump()))
 
     def on_batch_end(self):
        if self.build_dict_from_prev_batch() == False:
-           self.add_header_bytes(self.process_header(json.dumps(self.cur_dict)))
+           self.add_header_bytes(self.process_header(self.dict_dump()))
 
+    def process_line(self, line, event):
+        if event == None:
+            event = ParsedEvent(line)
 
-    def process(self, data):
-        # print(f'cur entries: {len(self.cur_dict)}')
-
-        evt = json.loads(data.decode('utf-8'))
-        actions2 = []
-        for action in evt["c"]["_multi"]:
-            x = json.dumps(action)
-            if x in self.cur_dict:
-                self.hits += 1
-                actions2.append({ '__idx': self.cur_dict[x]})
+        from_prev_batch = self.build_dict_from_prev_batch()
+        self.line_event = event
+        self.line_hits = []
+        self.line_misses = 0
+        self.line_collisions = 0
+        self.pending_actions = []
+        items = []
+        for action, x, fp in zip(event.actions, event.action_keys, event.action_fps):
+            if fp in self.cur_dict and self.dict_texts[fp] == x:
+                self.line_hits.append(fp)
+                items.append(self.cur_dict[fp])
+            elif fp in self.cur_dict:
+                # another action owns this fingerprint, send this one as is
+                self.line_collisions += 1
+                self.line_misses += 1
+                items.append(x)
             else:
-                self.misses += 1
-                if self.build_dict_from_prev_batch():
-                    actions2.append(action)
-                else:
-                    actions2.append(self.register_new_action(x, action))
-
-            if self.build_dict_from_prev_batch():
-                if x in self.action_set:
-                    self.action_set[x] += 1
+                self.line_misses += 1
+                if from_prev_batch:
+                    items.append(x)
                 else:
-                    self.action_set[x] = 1
-
-            evt["c"]["_multi"] = actions2
+                    items.append(self.register_new_action(fp, x, action))
 
-        new_dump = json.dumps(evt)
-        return self.process_transformed_event(new_dump)
+        return self.process_transformed_event(self.encode_event(event, items))
 
 class DedupSimple(Dedup):
     def __init__(self, max_dict_size, max_batch_size):
         super().__init__('simple', max_dict_size, max_batch_size)
 
     def process_header(self, dict_dump):
-        return len(dict_dump)
+        return self.emit(SECTION_DEDUP, CODEC_RAW, bytes(dict_dump, 'utf-8'))
 
-    def process_transformed_event(self, line):
-        return len(line)
+    def process_transformed_event(self, data):
+        return self.emit(self.event_kind, CODEC_RAW, data)
 
 class DedupZstd(Dedup):
-    def __init__(self, params, max_batch_size):
-        self.level = params[0]
-        self.max_dict_size = params[1]
-        super().__init__(f'zstd_{self.level}', self.max_dict_size, max_batch_size)
+    def __init__(self, level, max_dict_size, max_batch_size, name='zstd'):
+        self.level = level
+        super().__init__(f'{name}_{self.level}', max_dict_size, max_batch_size)
 
     def process_header(self, dict_dump):
         data = bytes(dict_dump, 'utf-8')
-        return len(zstd.ZstdCompressor(level=self.level).compress(data))
+        return self.emit(SECTION_DEDUP, CODEC_ZSTD, zstd_contexts.get(self.level).compress(data))
+
+    def process_transformed_event(self, data):
+        return self.emit(self.event_kind, CODEC_ZSTD, zstd_contexts.get(self.level).compress(data))
+
+# dedup-zstd with a dict that grows or shrinks based on how much of the previous one got used,
+# so low overlap batches don't pay for a header full of dead entries
+class DedupZstdAdaptive(DedupZstd):
+    # shrink when less than this fraction of the dict entries showed up in the batch
+    MIN_USED_RATIO = 0.75
+    # grow when the dict was well used but this fraction of actions still missed it
+    MAX_MISS_RATIO = 0.05
+
+    def __init__(self, level, max_dict_size, min_dict_size, max_batch_size):
+        super().__init__(level, max_dict_size, max_batch_size, 'zstd-adaptive')
+        self.min_dict_size = min_dict_size
+        self.target_dict_size = self.max_dict_size
+        self.dict_sizes = []
+
+    def next_dict_size(self, log_line):
+        if log_line != None:
+            dict_lines, used_entries, hits, misses = log_line
+            used_ratio = used_entries / dict_lines
+            miss_ratio = misses / max(hits + misses, 1)
+            if used_ratio < DedupZstdAdaptive.MIN_USED_RATIO:
+                # never shrink by more than half in one go, usage tends to be noisy
+                self.target_dict_size *= max(used_ratio / DedupZstdAdaptive.MIN_USED_RATIO, 0.5)
+            elif miss_ratio > DedupZstdAdaptive.MAX_MISS_RATIO:
+                self.target_dict_size *= 1.25
+            self.target_dict_size = int(min(max(self.target_dict_size, self.min_dict_size), self.max_dict_size))
+        self.dict_sizes.append(self.target_dict_size)
+        return self.target_dict_size
+
+    def on_restart(self):
+        super().on_restart()
+        self.target_dict_size = self.max_dict_size
+
+    def get_header(self):
+        return f'{super().get_header()},mean-dict-target'
+
+    def gen_specific_csv(self):
+        return f'{super().gen_specific_csv()},{np.mean(self.dict_sizes) if len(self.dict_sizes) > 0 else ""}'
+
+    def get_results(self):
+        res = super().get_results()
+        res['dict_sizes'] = self.dict_sizes
         return res
 
-    def process_transformed_event(self, line):
-        data = bytes(line, 'utf-8')
-        return len(zstd.ZstdCompressor(level=self.level).compress(data))
+    def set_results(self, results):
+        super().set_results(results)
+        self.dict_sizes = results['dict_sizes']
 
 class DedupZstd2(Dedup):
-    def __init__(self, params, max_batch_size):
-        self.level = params[0]
-        self.max_dict_size = params[1]
-        super().__init__(f'zstd2_{self.level}', self.max_dict_size, max_batch_size)
+    def __init__(self, level, max_dict_size, max_batch_size, name='zstd2'):
+        self.level = level
+        super().__init__(f'{name}_{self.level}', max_dict_size, max_batch_size)
         self.current_dict_size = 0
-        self.pending_actions = []
 
     def build_dict_from_prev_batch(self):
         return False
@@ -253,158 +1348,399 @@ class DedupZstd2(Dedup):
     def does_item_overflow(self, item_size, cur_size, max_size):
         # we use this to estimate how big the dictionary will compress to. (we use a static 2.8 compression ratio)
         estimated_dict_size = self.current_dict_size / 2.8
-        res = item_size + estimated_dict_size + cur_size > max_size
-        if not res:
-            for p in self.pending_actions:
-                self.cur_dict[p[0]] = p[1]
-            self.pending_actions = []
-        return res
-
-    def register_new_action(self, action, json_action):
+        return item_size + estimated_dict_size + cur_size > max_size
+
+    def boundary_sizes(self, item_size):
+        line_dict_size = sum(len(p[1]) for p in self.pending_actions)
+        return self.cur_batch_size + (self.current_dict_size - line_dict_size) / 2.8, item_size + line_dict_size / 2.8
+
+    # the dict starts over every batch, so new actions of the line would keep ids numbered after the
+    # old dict's entries. Process it again to number them from 0
+    def revalidate_overflow(self, line, event, item_size):
+        if len(self.pending_actions) > 0:
+            return None
+        return self.revalidate_refs(item_size)
+
+    # refs are only valid while the entries they point to are still in the dict, new actions only
+    # get their ids once the line is added
+    def revalidate_refs(self, item_size):
+        for fp in self.line_hits:
+            if fp not in self.cur_dict:
+                return None
+        self.current_dict_size = sum(len(p[1]) for p in self.pending_actions)
+        return item_size
+
+    def register_new_action(self, fp, action, json_action):
+        # the same action twice in a line goes in once
+        for p in self.pending_actions:
+            if p[0] == fp:
+                return p[2] if p[1] == action else action
         self.current_dict_size += len(action)
-        action_id = f'id_{random.randint(0, 1_000_000_000)}'
+        action_id = self.new_action_id()
         # we want to avoid commiting new entries to the dictionary if we don't have to
-        self.pending_actions.append([action, action_id])
-        return { '__idx': action_id }
+        self.pending_actions.append([fp, action, action_id])
+        return action_id
 
-    def process_transformed_event(self, line):
-        data = bytes(line, 'utf-8')
-        return len(zstd.ZstdCompressor(level=self.level).compress(data))
+    def process_transformed_event(self, data):
+        return self.emit(self.event_kind, CODEC_ZSTD, zstd_contexts.get(self.level).compress(data))
 
     def process_header(self, dict_dump):
         data = bytes(dict_dump, 'utf-8')
-        return len(zstd.ZstdCompressor(level=self.level).compress(data))
-        return res
+        return self.emit(SECTION_DEDUP, CODEC_ZSTD, zstd_contexts.get(self.level).compress(data))
 
     def on_batch_end(self):
         super().on_batch_end()
         self.current_dict_size = 0
-        self.pending_actions = []
 
 
+# Rolling dedup: client and server keep the action dict across batches and each batch only carries
+# the entries added and evicted since the previous one. New actions get into the dict right away
+# (like dedup-zstd2) and max_dict_size is the memory budget enforced at every batch end.
+class DedupZstdRolling(DedupZstd2):
+    POLICIES = ['lru', 'lfu', 'size']
+
+    # max_dict_size is the memory budget in bytes of action text
+    def __init__(self, level, max_dict_size, policy, max_batch_size):
+        self.policy = policy
+        if self.policy not in DedupZstdRolling.POLICIES:
+            raise Exception(f'unknown eviction policy {self.policy}')
+        super().__init__(level, max_dict_size, max_batch_size, f'zstd-rolling-{self.policy}')
+        self.cache_size = 0
+        self.clock = 0
+        self.uses = dict()
+        self.last_used = dict()
+        self.added = dict()
+        self.batch_used = set()
+        # ids of evicted entries, handed out again lowest first so ids stay small
+        self.free_ids = []
+        # the server's dict is out of sync (restart or lost batch), the next delta carries the whole dict
+        self.resync = False
+        # with --shed-memory, bytes of action text the next eviction goes down to (None is max_dict_size)
+        self.shed_cap = None
+        # entries, evicted, added, header bytes
+        self.rolling_batch_stats = []
+
+    def get_header(self):
+        return f'{super().get_header()},mean-dict-entries,mean-evicted,mean-added'
+
+    def gen_specific_csv(self):
+        if len(self.rolling_batch_stats) == 0:
+            return f'{super().gen_specific_csv()},,,'
+        n = np.array(self.rolling_batch_stats)
+        return f'{super().gen_specific_csv()},{np.mean(n[:,0])},{np.mean(n[:,1])},{np.mean(n[:,2])}'
+
+    def get_results(self):
+        res = super().get_results()
+        res['rolling_batch_stats'] = self.rolling_batch_stats
+        return res
+
+    def set_results(self, results):
+        super().set_results(results)
+        self.rolling_batch_stats = results['rolling_batch_stats']
+
+    def on_dict_hit(self, fp):
+        self.uses[fp] += 1
+        self.last_used[fp] = self.clock
+        self.batch_used.add(fp)
+
+    # pending actions only take their id once the line is added, so hand out the ids they will get
+    def new_action_id(self):
+        k = len(self.pending_actions)
+        if k < len(self.free_ids):
+            return self.free_ids[k]
+        return self.next_id + k - len(self.free_ids)
+
+    # the dict survives the batch, so the ids new actions of the line got are still free
+    def revalidate_overflow(self, line, event, item_size):
+        return self.revalidate_refs(item_size)
+
+    def add_dict_entry(self, fp, action, action_id):
+        super().add_dict_entry(fp, action, action_id)
+        # an overflowing line can take its ids before an eviction frees lower ones, so look it up
+        i = bisect.bisect_left(self.free_ids, action_id)
+        if i < len(self.free_ids) and self.free_ids[i] == action_id:
+            del self.free_ids[i]
+        self.added[fp] = action_id
+        self.uses[fp] = 1
+        self.last_used[fp] = self.clock
+        self.cache_size += len(action)
+
+    def on_item_added(self):
+        self.clock += 1
+        super().on_item_added()
+
+    # lower goes first
+    def eviction_key(self, fp):
+        if self.policy == 'lru':
+            return self.last_used[fp]
+        if self.policy == 'lfu':
+            return (self.uses[fp], self.last_used[fp])
+        # bytes a ref saves per byte of budget the entry holds
+        ref_len = self.ref_size(self.cur_dict[fp])
+        text_len = len(self.dict_texts[fp])
+        return (self.uses[fp] * (text_len - ref_len) / text_len, self.last_used[fp])
+
+    def evict(self):
+        evicted = []
+        limit = self.max_dict_size if self.shed_cap == None else min(self.max_dict_size, self.shed_cap)
+        self.shed_cap = None
+        if self.cache_size <= limit:
+            return evicted
+        # a line that overflowed the batch can go into the next one as is if its refs survive
+        keep = set(self.line_hits)
+        for fp in sorted(self.cur_dict, key=self.eviction_key):
+            if self.cache_size <= limit:
+                break
+            if fp in keep:
+                continue
+            self.cache_size -= len(self.dict_texts[fp])
+            evicted.append(self.remove_dict_entry(fp))
+            bisect.insort(self.free_ids, evicted[-1])
+            del self.uses[fp]
+            del self.last_used[fp]
+        return evicted
+
+    def on_batch_end(self):
+        # entries can be added and evicted in the same batch, so grab their text first
+        resend = self.cur_dict if self.resync else self.added
+        added = dict((self.dict_texts[fp], action_id) for fp, action_id in resend.items())
+        evicted = self.evict()
+        delta = { 'add': added, 'evict': evicted }
+        if self.resync:
+            delta['reset'] = True
+            self.resync = False
+        delta = json.dumps(delta)
+        header_size = self.emit(SECTION_DEDUP_DELTA, CODEC_ZSTD, zstd_contexts.get(self.level).compress(bytes(delta, 'utf-8')))
+        self.add_header_bytes(header_size)
+        self.rolling_batch_stats.append([len(self.cur_dict), len(evicted), len(self.added), header_size])
+        self.added = dict()
+        self.current_dict_size = 0
+
+    def on_restart(self):
+        super().on_restart()
+        self.cache_size = 0
+        self.uses = dict()
+        self.last_used = dict()
+        self.added = dict()
+        self.batch_used = set()
+        self.free_ids = []
+        self.shed_cap = None
+        self.resync = True
+
+    def on_batch_dropped(self):
+        self.resync = True
+
+    def state_sizes(self):
+        sizes = super().state_sizes()
+        # use counts, last use clocks and the ids up for reuse
+        sizes['counters'] += len(self.uses) * (FINGERPRINT_BYTES + 8) + len(self.free_ids) * 4
+        return sizes
+
+    # evictions have to reach the server in a delta, so cap the dict and let the end of the next batch
+    # evict down to it. The cap only holds for that batch, once the state fits the dict can grow back
+    def shed_state(self, excess):
+        self.shed_cap = max(0, min(self.max_dict_size, self.cache_size) - excess)
+        return max(0, self.cache_size - self.shed_cap)
+
+    def batch_done(self, batch_lines):
+        # the dict survives the batch, only the per batch counters reset
+        self.dedup_batch_stats.append([len(self.cur_dict), len(self.batch_used), self.hits, self.misses])
+        self.batch_used = set()
+        self.hits = self.misses = 0
+
 class DedupZstd3(Dedup):
-    def __init__(self, params, max_batch_size):
-        self.level = params[0]
-        self.max_dict_size = params[1]
-        super().__init__(f'zstd3_{self.level}', self.max_dict_size, max_batch_size)
+    def __init__(self, level, max_dict_size, max_batch_size):
+        self.level = level
+        super().__init__(f'zstd3_{self.level}', max_dict_size, max_batch_size)
 
     def build_dict_from_prev_batch(self):
         return False
 
-    def register_new_action(self, action, json_action):
-        action_id = f'id_{random.randint(0, 1_000_000_000)}'
+    def register_new_action(self, fp, action, json_action):
         # we want to avoid commiting new entries to the dictionary if we don't have to
-        self.cur_dict[action] = action_id
-        return json_action
+        self.add_dict_entry(fp, action, self.new_action_id())
+        return action
 
-    def process_transformed_event(self, line):
-        data = bytes(line, 'utf-8')
-        return len(zstd.ZstdCompressor(level=self.level).compress(data))
+    def process_transformed_event(self, data):
+        return self.emit(self.event_kind, CODEC_ZSTD, zstd_contexts.get(self.level).compress(data))
 
     def process_header(self, dict_dump):
-        # data = bytes(dict_dump, 'utf-8')
-        # return len(zstd.ZstdCompressor(level=self.level).compress(data))
-        # return res
+        # we assume the server can rebuild the ids so the dict is free: they count up in the order
+        # actions first show up. The decoder doesn't do that, so the wire batch still carries them
+        if self.wire != None:
+            data = bytes(dict_dump, 'utf-8')
+            self.wire.add_section(SECTION_DEDUP, CODEC_ZSTD, 0, zstd_contexts.get(self.level).compress(data))
         return 0
 
 
 class DedupZstdDict(Dedup):
-    def __init__(self, params, max_batch_size):
-        self.level = params[0]
-        self.max_dict_size = params[1]
-        self.max_zdict_size = params[2]
+    def __init__(self, level, max_dict_size, max_zdict_size, max_batch_size):
+        self.level = level
+        self.max_zdict_size = max_zdict_size
         self.zdict_lines = []
+        self.line_sample = None
         self.cur_zdict = None
-        super().__init__(f'zstd-dict_{self.level}_{self.max_zdict_size}', self.max_dict_size, max_batch_size)
+        super().__init__(f'zstd-dict_{self.level}_{self.max_zdict_size}', max_dict_size, max_batch_size)
+        self.trainer = DictTrainer(self.max_zdict_size)
 
     def batch_done(self, batch_lines):
         super().batch_done(batch_lines)
-        self.cur_zdict = zstd.train_dictionary(self.max_zdict_size, self.zdict_lines)
+        self.cur_zdict = self.retrain_zdict(self.cur_zdict, self.zdict_lines)
+        self.zdict_lines = []
+
+    def on_restart(self):
+        super().on_restart()
+        zstd_contexts.drop(self.cur_zdict)
+        self.cur_zdict = None
+        self.trainer.reset()
         self.zdict_lines = []
 
-    def compress_and_log(self, text_data):
-        data = bytes(text_data, 'utf-8')
-        self.zdict_lines.append(data)
+    # events are only sampled once the line is part of the batch
+    def on_item_added(self):
+        super().on_item_added()
+        self.zdict_lines.append(self.line_sample)
+
+    def state_sizes(self):
+        sizes = super().state_sizes()
+        sizes['train'] = sum(len(x) for x in self.zdict_lines)
+        sizes['zdict'] = len(self.cur_zdict.as_bytes()) if self.cur_zdict != None else 0
+        return sizes
+
+    def compress_and_log(self, data, kind):
+        if kind == self.event_kind:
+            self.line_sample = data
+        else:
+            self.zdict_lines.append(data)
         if self.cur_zdict != None:
-            return len(zstd.ZstdCompressor(level=self.level, dict_data=self.cur_zdict).compress(data))
-        return len(zstd.ZstdCompressor(level=self.level).compress(data))
+            return self.emit(kind, CODEC_ZSTD, zstd_contexts.get(self.level, self.cur_zdict).compress(data), FLAG_ZDICT)
+        return self.emit(kind, CODEC_ZSTD, zstd_contexts.get(self.level).compress(data))
 
     def process_header(self, dict_dump):
-        dedup_dict_size = self.compress_and_log(dict_dump)
+        dedup_dict_size = self.compress_and_log(bytes(dict_dump, 'utf-8'), SECTION_DEDUP)
+        # with background training the first batches go out before any zstd dict is ready
+        if self.cur_zdict == None:
+            return dedup_dict_size
         dict_bytes = self.cur_zdict.as_bytes()
-        comp_dict_size = len(zstd.ZstdCompressor(level=self.level).compress(dict_bytes))
+        comp_dict_size = self.emit(SECTION_ZDICT, CODEC_ZSTD, zstd_contexts.get(self.level).compress(dict_bytes))
         return dedup_dict_size + comp_dict_size
 
-    def process_transformed_event(self, line):
-        return self.compress_and_log(line)
+    def process_transformed_event(self, data):
+        return self.compress_and_log(data, self.event_kind)
 
 #don't zdict compress the actions dict
 class DedupZstdDict2(Dedup):
-    def __init__(self, params, max_batch_size):
-        self.level = params[0]
-        self.max_dict_size = params[1]
-        self.max_zdict_size = params[2]
+    def __init__(self, level, max_dict_size, max_zdict_size, max_batch_size):
+        self.level = level
+        self.max_zdict_size = max_zdict_size
         self.zdict_lines = []
+        self.line_sample = None
         self.cur_zdict = None
-        super().__init__(f'zstd-dict2_{self.level}_{self.max_zdict_size}', self.max_dict_size, max_batch_size)
+        super().__init__(f'zstd-dict2_{self.level}_{self.max_zdict_size}', max_dict_size, max_batch_size)
+        self.trainer = DictTrainer(self.max_zdict_size)
 
     def batch_done(self, batch_lines):
         super().batch_done(batch_lines)
-        self.cur_zdict = zstd.train_dictionary(self.max_zdict_size, self.zdict_lines)
+        self.cur_zdict = self.retrain_zdict(self.cur_zdict, self.zdict_lines)
+        self.zdict_lines = []
+
+    def on_restart(self):
+        super().on_restart()
+        zstd_contexts.drop(self.cur_zdict)
+        self.cur_zdict = None
+        self.trainer.reset()
         self.zdict_lines = []
 
-    def compress_and_log(self, text_data, use_dict):
-        data = bytes(text_data, 'utf-8')
+    # events are only sampled once the line is part of the batch
+    def on_item_added(self):
+        super().on_item_added()
+        self.zdict_lines.append(self.line_sample)
+
+    def state_sizes(self):
+        sizes = super().state_sizes()
+        sizes['train'] = sum(len(x) for x in self.zdict_lines)
+        sizes['zdict'] = len(self.cur_zdict.as_bytes()) if self.cur_zdict != None else 0
+        return sizes
+
+    def compress_and_log(self, data, use_dict, kind):
         if use_dict:
-            self.zdict_lines.append(data)
+            self.line_sample = data
         if self.cur_zdict != None and use_dict:
-            return len(zstd.ZstdCompressor(level=self.level, dict_data=self.cur_zdict).compress(data))
-        return len(zstd.ZstdCompressor(level=self.level).compress(data))
+            return self.emit(kind, CODEC_ZSTD, zstd_contexts.get(self.level, self.cur_zdict).compress(data), FLAG_ZDICT)
+        return self.emit(kind, CODEC_ZSTD, zstd_contexts.get(self.level).compress(data))
 
     def process_header(self, dict_dump):
-        dedup_dict_size = self.compress_and_log(dict_dump, False)
+        dedup_dict_size = self.compress_and_log(bytes(dict_dump, 'utf-8'), False, SECTION_DEDUP)
+        # with background training the first batches go out before any zstd dict is ready
+        if self.cur_zdict == None:
+            return dedup_dict_size
         dict_bytes = self.cur_zdict.as_bytes()
-        comp_dict_size = len(zstd.ZstdCompressor(level=self.level).compress(dict_bytes))
+        comp_dict_size = self.emit(SECTION_ZDICT, CODEC_ZSTD, zstd_contexts.get(self.level).compress(dict_bytes))
         return dedup_dict_size + comp_dict_size
 
-    def process_transformed_event(self, line):
-        return self.compress_and_log(line, True)
+    def process_transformed_event(self, data):
+        return self.compress_and_log(data, True, self.event_kind)
 
 #zdict compress only the actions dict
 class DedupZstdDict3(Dedup):
-    def __init__(self, params, max_batch_size):
-        self.level = params[0]
-        self.max_dict_size = params[1]
-        self.max_zdict_size = params[2]
+    def __init__(self, level, max_dict_size, max_zdict_size, max_batch_size):
+        self.level = level
+        self.max_zdict_size = max_zdict_size
         self.cur_zdict = None
-        super().__init__(f'zstd-dict3_{self.level}_{self.max_zdict_size}', self.max_dict_size, max_batch_size)
+        self.zdict_failures = 0
+        super().__init__(f'zstd-dict3_{self.level}_{self.max_zdict_size}', max_dict_size, max_batch_size)
+
+    def failed_trainings(self):
+        return self.zdict_failures
+
+    def get_results(self):
+        res = super().get_results()
+        res['zdict_failures'] = self.zdict_failures
+        return res
+
+    def set_results(self, results):
+        super().set_results(results)
+        self.zdict_failures = results['zdict_failures']
+
+    def state_sizes(self):
+        sizes = super().state_sizes()
+        sizes['zdict'] = len(self.cur_zdict.as_bytes()) if self.cur_zdict != None else 0
+        return sizes
 
     def process_header(self, dict_dump):
         train_data = []
-        for k in self.cur_dict:
-            train_data.append(bytes(k, 'utf-8'))
+        for fp in self.cur_dict:
+            train_data.append(bytes(self.dict_texts[fp], 'utf-8'))
         # train on each action independently
-        self.cur_zdict = zstd.train_dictionary(self.max_zdict_size, train_data)
+        new_zdict = train_zdict(self.max_zdict_size, train_data)
+        if new_zdict != None:
+            zstd_contexts.drop(self.cur_zdict)
+            self.cur_zdict = new_zdict
+        else:
+            self.zdict_failures += 1
 
         data = bytes(dict_dump, 'utf-8')
-        dedup_dict_size = len(zstd.ZstdCompressor(level=self.level, dict_data = self.cur_zdict).compress(data))
+        if self.cur_zdict == None:
+            return self.emit(SECTION_DEDUP, CODEC_ZSTD, zstd_contexts.get(self.level).compress(data))
+        dedup_dict_size = self.emit(SECTION_DEDUP, CODEC_ZSTD, zstd_contexts.get(self.level, self.cur_zdict).compress(data), FLAG_ZDICT)
 
         dict_bytes = self.cur_zdict.as_bytes()
-        comp_dict_size = len(zstd.ZstdCompressor(level=self.level).compress(dict_bytes))
+        comp_dict_size = self.emit(SECTION_ZDICT, CODEC_ZSTD, zstd_contexts.get(self.level).compress(dict_bytes))
         return dedup_dict_size + comp_dict_size
 
-    def process_transformed_event(self, line):
-        data = bytes(line, 'utf-8')
-        return len(zstd.ZstdCompressor(level=self.level).compress(data))
+    def process_transformed_event(self, data):
+        return self.emit(self.event_kind, CODEC_ZSTD, zstd_contexts.get(self.level).compress(data))
 
 # zstd-dict only mode
 class ZstdDict(AccumulateBatch):
-    def __init__(self, params, max_batch_size):
-        super().__init__(f'zstd-dict_{params[0]}_{params[1]}', max_batch_size)
-        self.level = params[0]
-        self.train_dict_size = params[1]
+    def __init__(self, level, train_dict_size, max_batch_size):
+        super().__init__(f'zstd-dict_{level}_{train_dict_size}', max_batch_size)
+        self.level = level
+        self.train_dict_size = train_dict_size
         self.cur_dict = None
+        # the dict the last line was compressed with
+        self.line_dict = None
         self.acc_lines = []
+        self.trainer = DictTrainer(self.train_dict_size)
 
     def batch_done(self, batch_lines):
         self.acc_lines.extend(batch_lines)
@@ -412,19 +1748,48 @@ class ZstdDict(AccumulateBatch):
         if len(self.acc_lines) > 400:
             self.acc_lines = self.acc_lines[-400:]
 
-        self.cur_dict = zstd.train_dictionary(self.train_dict_size, self.acc_lines)
+        self.cur_dict = self.retrain_zdict(self.cur_dict, self.acc_lines)
+
+    def on_restart(self):
+        super().on_restart()
+        zstd_contexts.drop(self.cur_dict)
+        self.cur_dict = None
+        self.trainer.reset()
+        self.acc_lines = []
+
+    def state_sizes(self):
+        sizes = super().state_sizes()
+        # only zstd-dict needs the lines of the batch, they join the history it trains on
+        sizes['lines'] = sum(len(line) for line in self.batch_data)
+        sizes['train'] = sum(len(line) for line in self.acc_lines)
+        sizes['zdict'] = len(self.cur_dict.as_bytes()) if self.cur_dict != None else 0
+        return sizes
+
+    # the history only feeds the next training, the oldest lines go first
+    def shed_state(self, excess):
+        shed = 0
+        while shed < excess and len(self.acc_lines) > 0:
+            shed += len(self.acc_lines.pop(0))
+        return shed
 
     def on_batch_start(self):
         if self.cur_dict != None:
             dict_bytes = self.cur_dict.as_bytes()
-            comp_dict = zstd.ZstdCompressor(level=self.level).compress(dict_bytes)
-            self.add_header_bytes(len(comp_dict))
+            comp_dict = zstd_contexts.get(self.level).compress(dict_bytes)
+            self.add_header_bytes(self.emit(SECTION_ZDICT, CODEC_ZSTD, comp_dict))
+
+    # with background training the dict often survives the boundary and so does the line
+    def revalidate_overflow(self, line, event, item_size):
+        if self.cur_dict is self.line_dict:
+            return item_size
+        return None
 
     def process(self, data):
+        self.line_dict = self.cur_dict
         if self.cur_dict == None:
-            return len(zstd.ZstdCompressor(level=self.level).compress(data))
+            return self.emit(SECTION_EVENT, CODEC_ZSTD, zstd_contexts.get(self.level).compress(data))
 
-        res = len(zstd.ZstdCompressor(level=self.level, dict_data=self.cur_dict).compress(data))
+        res = self.emit(SECTION_EVENT, CODEC_ZSTD, zstd_contexts.get(self.level, self.cur_dict).compress(data), FLAG_ZDICT)
         # print(f'{self.label} :: {len(self.batches)} :: {res}' )
         return res
 
@@ -435,7 +1800,7 @@ class Deflate(LineProcessor):
         self.level = level
     
     def process(self, data):
-        return len(zlib.compress(data, level=self.level))
+        return self.emit(SECTION_EVENT, CODEC_ZLIB, zlib.compress(data, level=self.level))
 
 class Zstd(LineProcessor):
     def __init__(self, level, max_batch_size):
@@ -443,7 +1808,7 @@ class Zstd(LineProcessor):
         self.level = level
     
     def process(self, data):
-        return len(zstd.ZstdCompressor(level=self.level).compress(data))
+        return self.emit(SECTION_EVENT, CODEC_ZSTD, zstd_contexts.get(self.level).compress(data))
 
 class Brotli(LineProcessor):
     def __init__(self, level, max_batch_size):
@@ -451,14 +1816,317 @@ class Brotli(LineProcessor):
         self.level = level
     
     def process(self, data):
-        return len(brotli.compress(data, quality=self.level))
+        return self.emit(SECTION_EVENT, CODEC_BROTLI, brotli.compress(data, quality=self.level))
 
 class Snappy(LineProcessor):
     def __init__(self, max_batch_size):
         super().__init__('snappy', max_batch_size)
     
     def process(self, data):
-        return len(snappy.compress(data))
+        return self.emit(SECTION_EVENT, CODEC_SNAPPY, snappy.compress(data))
+
+# Whole batch compression: every line of a batch goes through one compression stream, which is how
+# clients really ship data. We only flush (ending a block, which costs a bit of ratio) when the
+# estimated size gets close to the limit, so the size we check is always an actual flushed size.
+# The line that crosses the limit stays in the batch and what went over is tracked as overflow.
+class StreamBatch(LineProcessor):
+    # start flushing every line once we estimate to be this close to the limit
+    FLUSH_MARGIN = 0.9
+    # and never keep more than this much raw data unflushed
+    MAX_PENDING_RAW = 128 * 1024
+
+    def __init__(self, label, codec, max_batch_size):
+        super().__init__(label, max_batch_size)
+        self.codec = codec
+        self.stream = None
+        self.pending_raw = 0
+        self.frame = bytearray()
+        # guess for the first batch, then the ratio of the previous one
+        self.ratio = 3.0
+        # overflow bytes, flushes
+        self.stream_batch_stats = []
+        self.flushes = 0
+
+    # returns an object with compress(data), flush() and finish(), all returning bytes
+    def new_stream(self):
+        raise Exception("must override")
+
+    def get_header(self):
+        return 'mean-overflow,max-overflow,mean-flushes'
+
+    def gen_specific_csv(self):
+        n = np.array(self.stream_batch_stats)
+        return f'{np.mean(n[:,0])},{np.max(n[:,0])},{np.mean(n[:,1])}'
+
+    def get_results(self):
+        res = super().get_results()
+        res['stream_batch_stats'] = self.stream_batch_stats
+        return res
+
+    def set_results(self, results):
+        super().set_results(results)
+        self.stream_batch_stats = results['stream_batch_stats']
+
+    def write(self, data):
+        self.cur_batch_size += len(data)
+        if self.wire != None:
+            self.frame += data
+
+    def on_batch_start(self):
+        self.stream = self.new_stream()
+        self.pending_raw = 0
+        self.flushes = 0
+        self.frame = bytearray()
+
+    def on_restart(self):
+        self.ratio = 3.0
+
+    def on_batch_end(self):
+        self.write(self.stream.finish())
+        self.stream_batch_stats.append([max(0, self.cur_batch_size - self.max_batch_size), self.flushes])
+        self.ratio = self.cur_batch_raw_size / self.cur_batch_size
+        if self.wire != None:
+            self.wire.add_section(SECTION_EVENT_STREAM, self.codec, 0, bytes(self.frame))
+
+    def add_bytes(self, line, event=None):
+        if self.wire != None:
+            self.wire.start_line()
+        start = time.thread_time_ns()
+        self.write(self.stream.compress(line))
+        self.pending_raw += len(line)
+        estimate = self.cur_batch_size + self.pending_raw / self.ratio
+        if estimate >= self.max_batch_size * StreamBatch.FLUSH_MARGIN or self.pending_raw >= StreamBatch.MAX_PENDING_RAW:
+            self.write(self.stream.flush())
+            self.pending_raw = 0
+            self.flushes += 1
+        self.timing.add_line(time.thread_time_ns() - start)
+        if self.wire != None:
+            self.wire.commit_line(line)
+
+        self.cur_batch_raw_size += len(line)
+        self.cur_batch_line_count += 1
+        if self.cur_batch_size >= self.max_batch_size:
+            self.finish_batch()
+            # the line that crossed the limit stays in the batch so nothing is left unused
+            self.boundary_stats.append([0, self.stream_batch_stats[-1][0]])
+
+class ZstdStream:
+    def __init__(self, cctx):
+        self.cobj = cctx.compressobj()
+
+    def compress(self, data):
+        return self.cobj.compress(data)
+
+    def flush(self):
+        return self.cobj.flush(zstd.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.cobj.flush()
+
+class ZlibStream:
+    def __init__(self, level):
+        self.cobj = zlib.compressobj(level)
+
+    def compress(self, data):
+        return self.cobj.compress(data)
+
+    def flush(self):
+        return self.cobj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.cobj.flush()
+
+class BrotliStream:
+    def __init__(self, level):
+        self.cobj = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.cobj.process(data)
+
+    def flush(self):
+        return self.cobj.flush()
+
+    def finish(self):
+        return self.cobj.finish()
+
+class StreamZstd(StreamBatch):
+    def __init__(self, level, max_batch_size):
+        super().__init__(f'stream-zstd_{level}', CODEC_ZSTD, max_batch_size)
+        # a streaming context can't be shared with anyone else, so no zstd_contexts here
+        self.cctx = zstd.ZstdCompressor(level=level)
+
+    def new_stream(self):
+        return ZstdStream(self.cctx)
+
+class StreamDeflate(StreamBatch):
+    def __init__(self, level, max_batch_size):
+        super().__init__(f'stream-zlib_{level}', CODEC_ZLIB, max_batch_size)
+        self.level = level
+
+    def new_stream(self):
+        return ZlibStream(self.level)
+
+class StreamBrotli(StreamBatch):
+    def __init__(self, level, max_batch_size):
+        super().__init__(f'stream-brotli_{level}', CODEC_BROTLI, max_batch_size)
+        self.level = level
+
+    def new_stream(self):
+        return BrotliStream(self.level)
+
+# Whole batch columnar encoding: actions that are flat dicts of floats (what we log) go into a
+# float64 matrix instead of json text, see encode_columnar. The batch is only compressed once it's
+# closed, so once the encoded size over the ratio of the previous batch gets close to the limit we
+# compress the whole batch with every new line, and close it with the last version that fit. If the
+# estimate was so off that the first try is already over, the lines that don't fit move to the next batch.
+class Columnar(LineProcessor):
+    # start trial compressions once we estimate to be this close to the limit
+    FIT_MARGIN = 0.9
+
+    # shuffle is 0/1 to byte shuffle the floats
+    def __init__(self, level, shuffle, max_batch_size):
+        self.level = level
+        self.shuffle = shuffle
+        super().__init__(f'columnar_{self.level}{"-shuffle" if self.shuffle else ""}', max_batch_size)
+        self.events = []
+        self.lines = []
+        self.pending_raw = 0
+        # guess for the first batch, then the ratio of the previous one
+        self.ratio = 3.0
+        # (lines, payload) of the last trial that fit
+        self.fitted = None
+        self.trials = 0
+        # schema of the batch as encode_columnar will pick it, known from its first float action
+        self.schema = None
+        # overflow bytes, fraction of the actions in the float matrix, trial compressions
+        self.columnar_batch_stats = []
+
+    def needs_parsed_event(self):
+        return True
+
+    def get_header(self):
+        return 'mean-overflow,max-overflow,mean-columnar-actions,mean-trials'
+
+    def gen_specific_csv(self):
+        n = np.array(self.columnar_batch_stats)
+        return f'{np.mean(n[:,0])},{np.max(n[:,0])},{np.mean(n[:,1])},{np.mean(n[:,2])}'
+
+    def get_results(self):
+        res = super().get_results()
+        res['columnar_batch_stats'] = self.columnar_batch_stats
+        return res
+
+    def set_results(self, results):
+        super().set_results(results)
+        self.columnar_batch_stats = results['columnar_batch_stats']
+
+    # close enough to the encoded size for the estimate, floats take 8 bytes whatever their text
+    def encoded_size(self, event):
+        if self.schema == None:
+            self.schema = columnar_schema([event])
+        size = len(event.prefix) + len(event.suffix) + 2
+        for action, key in zip(event.actions, event.action_keys):
+            if is_columnar(action, self.schema):
+                size += 8 * len(action)
+            else:
+                size += len(key)
+        return size
+
+    def compress(self, events):
+        return zstd_contexts.get(self.level).compress(encode_columnar(events, self.shuffle))
+
+    def on_batch_start(self):
+        self.events = []
+        self.lines = []
+        self.pending_raw = 0
+        self.fitted = None
+        self.trials = 0
+        self.schema = None
+
+    def on_restart(self):
+        self.ratio = 3.0
+
+    def state_sizes(self):
+        sizes = super().state_sizes()
+        sizes['lines'] = sum(len(line) for line in self.lines)
+        sizes['trial'] = len(self.fitted[1]) if self.fitted != None else 0
+        return sizes
+
+    def on_batch_end(self):
+        if len(self.events) == 0:
+            return
+        if self.fitted != None and self.fitted[0] == len(self.events):
+            payload = self.fitted[1]
+        else:
+            payload = self.compress(self.events)
+        size = self.emit(SECTION_COLUMNAR, CODEC_ZSTD, payload, FLAG_SHUFFLE if self.shuffle else 0)
+        self.cur_batch_size += size
+        self.ratio = self.pending_raw / size
+        n_actions = sum(len(evt.actions) for evt in self.events)
+        schema = columnar_schema(self.events) or []
+        n_floats = sum(1 for evt in self.events for a in evt.actions if is_columnar(a, schema))
+        self.columnar_batch_stats.append([max(0, self.cur_batch_size - self.max_batch_size), n_floats / n_actions if n_actions > 0 else 0, self.trials])
+
+    def add_bytes(self, line, event=None):
+        if event == None:
+            event = ParsedEvent(line)
+        if self.wire != None:
+            self.wire.start_line()
+        start = time.thread_time_ns()
+        line_raw = self.encoded_size(event)
+        if self.cur_batch_line_count > 0 and (self.pending_raw + line_raw) / self.ratio >= self.max_batch_size * Columnar.FIT_MARGIN:
+            payload = self.compress(self.events + [event])
+            self.trials += 1
+            self.ratio = (self.pending_raw + line_raw) / len(payload)
+            if len(payload) > self.max_batch_size:
+                overflow = len(payload) - self.max_batch_size
+                self.close_batch()
+                self.boundary_stats.append([self.max_batch_size - self.batches[-1][0], overflow])
+            else:
+                self.fitted = (len(self.events) + 1, payload)
+        self.append_line(line, event, line_raw)
+        self.timing.add_line(time.thread_time_ns() - start)
+
+    def append_line(self, line, event, line_raw):
+        self.events.append(event)
+        self.lines.append(line)
+        self.pending_raw += line_raw
+        if self.wire != None:
+            self.wire.commit_line(line)
+        self.cur_batch_raw_size += len(line)
+        self.cur_batch_line_count += 1
+
+    # largest number of lines from the start of the batch that compress under the limit, at least one
+    def fit_lines(self):
+        lo, hi = 1, len(self.events)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            payload = self.compress(self.events[:mid])
+            self.trials += 1
+            if len(payload) <= self.max_batch_size:
+                self.fitted = (mid, payload)
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def close_batch(self):
+        keep = len(self.events)
+        if self.fitted == None or self.fitted[0] != keep:
+            keep = self.fit_lines()
+        carried = list(zip(self.lines[keep:], self.events[keep:]))
+        del self.events[keep:]
+        del self.lines[keep:]
+        for line, event in carried:
+            self.pending_raw -= self.encoded_size(event)
+            self.cur_batch_raw_size -= len(line)
+            self.cur_batch_line_count -= 1
+        if self.wire != None and len(carried) > 0:
+            # columnar lines have no sections of their own, moving them is moving the line
+            del self.wire.lines[-len(carried):]
+        self.finish_batch()
+        for line, event in carried:
+            self.append_line(line, event, self.encoded_size(event))
 
 class Client:
     def __init__(self, id):
@@ -466,21 +2134,42 @@ class Client:
         self.procs = []
         self.lines = 0
         self.raw_size = 0
+        self.parse_events = False
+        # synthetic arrivals are a poisson process per client, the same for every worker
+        self.clock = 0.0
+        self.arrival_rng = np.random.default_rng([args.arrival_seed, id]) if args.arrival_rate != None else None
 
     def add_proc(self, proc):
         self.procs.append(proc)
+        self.parse_events = self.parse_events or proc.needs_parsed_event()
 
-    def add_line(self, line):
+    def add_bytes(self, data):
         self.lines += 1
-        self.raw_size += len(line)
-        data = bytes(line, 'utf-8')
+        self.raw_size += len(data)
+        # decode the event once for every processor instead of once per processor
+        event = ParsedEvent(data) if self.parse_events else None
+        now = self.arrival_time(data, event) if arrivals_enabled() else None
         for p in self.procs:
-            p.add_bytes(data)
+            if now != None:
+                p.advance(now)
+            p.add_bytes(data, event)
+
+    # seconds, from the event's timestamp field or the synthetic arrival rate
+    def arrival_time(self, data, event):
+        if args.timestamp_field != None:
+            evt = event.event if event != None else json.loads(data)
+            return parse_timestamp(evt[args.timestamp_field])
+        self.clock += self.arrival_rng.exponential(1 / args.arrival_rate)
+        return self.clock
 
     def start(self):
         for p in self.procs:
             p.start()
 
+    def flush(self):
+        for p in self.procs:
+            p.flush()
+
     def gen_csv(self, file_name, out_file):
         header = f'{file_name},{self.id},{self.lines},{self.raw_size}'
         for p in self.procs:
@@ -491,102 +2180,883 @@ class Client:
         for p in self.procs:
             p.report()
 
+        # with --async-train both, show what training in the background cost us in ratio
+        sync_procs = dict((p.label, p) for p in self.procs if not p.async_train)
+        for p in self.procs:
+            sync = sync_procs.get(p.label.replace('-async', '', 1)) if p.async_train else None
+            if sync != None and len(sync.batches) > 0 and len(p.batches) > 0:
+                print(f'{p.label} ratio-loss vs inline training: {(1 - p.mean_ratio() / sync.mean_ratio()) * 100:.1f}%')
+
 
 parser = argparse.ArgumentParser(description="Compression simulation")
-parser.add_argument('files', nargs='+', help='Log files to use')
-parser.add_argument('--clients', '-c', type=int, help='Number of clients to use (default 1)', default=1)
+parser.add_argument('files', nargs='*', help='Log files to use')
+parser.add_argument('--clients', '-c', type=int, help='Number of clients to shard the input across (default 1)', default=1)
+parser.add_argument('--shard', choices=['round-robin', 'shared'], default='round-robin',
+    help='How lines are assigned to clients: round-robin or by hash of the shared context (default round-robin)')
 parser.add_argument('--algo', nargs='?', 
-    help='Which compression algorithms to try: zlib, zstd, brotli, snappy, zstd-dict,dedup (default zstd)', default='zstd')
+    help='Which compression algorithms to try, comma separated. --list-algos shows them (default zstd)', default='zstd')
+parser.add_argument('--list-algos', help="List the registered algorithms with their params and grids", default=False, action='store_true')
+parser.add_argument('--plugin', action='append', default=[],
+    help='Module whose register(sim) adds algorithms, like the compression_sim.algos entry points do (repeatable)')
 parser.add_argument('--sweep', help="Param sweep the current best know algo (dedup_zstd)", default=False, action='store_true')
 parser.add_argument('--sweep2', help="Sweep top two (dedup_zstd and zstd-dict) with a reasonable grid", default=False, action='store_true')
 parser.add_argument('--csv', help="Gen stats in csv form", default=False, action='store_true')
 parser.add_argument('--prefix', help="Prefix for output files", default='')
+parser.add_argument('--mmap', help="mmap uncompressed input files instead of reading them in chunks", default=False, action='store_true')
+parser.add_argument('--chunk-size', type=int, help='Read size in bytes when streaming input files (default 1MB)', default=1024 * 1024)
+parser.add_argument('--wire', help="Encode real batches, decode them back and report decode throughput", default=False, action='store_true')
+parser.add_argument('--async-train', choices=['off', 'on', 'both'], default='off',
+    help='Train zstd dicts on background threads and swap them in at the next batch boundary. both also keeps the inline version to compare against (default off)')
+parser.add_argument('--train-threads', type=int, help='Background dict training threads per process (default 2)', default=2)
+parser.add_argument('--search', help="Guided param search (successive halving then hill climbing) over one --algo entry, see --space", default=None)
+parser.add_argument('--space', nargs='+', default=None,
+    help='Values of each param of the --search algo, either lo:hi:step or a comma separated list, optionally by name (e.g. level=1:19:1 max_dict_size=100000:300000:20000 policy=lru,lfu)')
+parser.add_argument('--search-configs', type=int, help='Random configs the search starts from (default 16)', default=16)
+parser.add_argument('--search-lines', type=int, help='Lines of each file the first search round looks at (default 200)', default=200)
+parser.add_argument('--search-eta', type=int, help='Each search round keeps 1/eta of the configs and looks at eta times more lines (default 3)', default=3)
+parser.add_argument('--search-seed', type=int, help='Seed for the starting configs of the search (default 0)', default=0)
+parser.add_argument('--estimate', type=float, default=None,
+    help='Estimate mean ratio and header size with 95%% intervals from this fraction of the lines of each file, taken as contiguous windows')
+parser.add_argument('--estimate-windows', type=int, help='Windows each file is sampled in, one per equal slice of the file (default 8)', default=8)
+parser.add_argument('--estimate-warmup', type=int, help='Batches at the start of each window left out of the estimate while dicts warm up (default 1)', default=1)
+parser.add_argument('--estimate-seed', type=int, help='Seed for where the windows start (default 0)', default=0)
+parser.add_argument('--escalate', help='With --estimate, fully run the processors whose ratio interval overlaps another one', default=False, action='store_true')
+parser.add_argument('--cache-dir', help='Where finished results are cached across runs (default .sim-cache)', default='.sim-cache')
+parser.add_argument('--no-cache', help="Don't read or write cached results", default=False, action='store_true')
+parser.add_argument('--cache-max-mb', type=int, help='Evict the least recently used cached results above this size (default 1024)', default=1024)
+parser.add_argument('--cache-invalidate', metavar='PATTERN', default=None,
+    help='Drop cached results whose processor label or input file contains PATTERN (all drops everything)')
+parser.add_argument('--restart-every', type=int, help='Restart clients after every N batches, losing dicts and everything else kept across batches (default 0, never)', default=0)
+parser.add_argument('--drop-every', type=int, help='Lose every Nth batch on the way to the server, like a partition would (default 0, never)', default=0)
+parser.add_argument('--recovery-batches', type=int, help='Batches after a start, restart or dropped batch counted as cold when measuring resync cost (default 1)', default=1)
+parser.add_argument('--batch-size', type=int, help='Max compressed batch size in bytes (default 202752, 198KB)', default=198 * 1024)
+parser.add_argument('--arrival-rate', type=float, help='Lines per second each client gets, as a poisson process. Enables batching delay stats', default=None)
+parser.add_argument('--arrival-seed', type=int, help='Seed of the synthetic arrivals (default 0)', default=0)
+parser.add_argument('--timestamp-field', help='Top level event field (numeric seconds or ISO 8601) to take arrival times from instead of --arrival-rate', default=None)
+parser.add_argument('--flush-ms', type=float, help='Close a batch once its oldest line waited this long, needs --arrival-rate or --timestamp-field', default=None)
+parser.add_argument('--memory-budget', type=int, help='Bytes of state each processor may keep across batches (dicts, counters, training data), batches going over are counted (default none)', default=None)
+parser.add_argument('--shed-memory', help='With --memory-budget, processors drop dict entries or training history to fit it', default=False, action='store_true')
+parser.add_argument('--refs', choices=['json', 'varint'], default='json',
+    help='How dedup processors send dict refs: {"__idx": id} json in the event text or a binary framing with varint ids (default json)')
+parser.add_argument('--fp-bits', type=int, choices=[64, 128], help='Width of the action fingerprints dedup dicts are keyed by (default 64)', default=64)
+parser.add_argument('--jobs', '-j', type=int, help='Number of worker processes to split processors and files across (default 1)', default=1)
 
 args = parser.parse_args()
+if len(args.files) == 0 and args.cache_invalidate == None and not args.list_algos:
+    parser.error('the following arguments are required: files')
+if args.flush_ms != None and args.arrival_rate == None and args.timestamp_field == None:
+    parser.error('--flush-ms needs --arrival-rate or --timestamp-field')
+if args.estimate != None and (args.estimate <= 0 or args.estimate > 1):
+    parser.error('--estimate is a fraction of the lines, in (0, 1]')
+if args.estimate != None and (args.clients > 1 or args.search != None):
+    parser.error('--estimate runs a single client and no --search')
 algo_names = args.algo.split(',')
-#TODO make it configurable
-MAX_BATCH_SIZE = 198 * 1024
-
-compression_algos = {
-    'zlib': [Deflate, 1, -1, 9],
-    'zstd': [Zstd, -1, 0, 19],
-    'zstd-dict':[ZstdDict, [13, 220_000], [13, 140_000] ],
-    'brotli': [Brotli, 0, 3, 11],
-    'snappy': [Snappy],
-    'dedup': [DedupSimple, 10_000, 20_000, 60_000, 100_000],
-    'dedup-zstd': [DedupZstd, [1, 200_000], [13, 200_000] ],
-    # 'dedup-zstd2': [DedupZstd2, [1, 200_000], [13, 200_000] ],
-    'dedup-zstd2': [DedupZstd2, [10, 200_000] ],
-    # 'dedup-zstd3': [DedupZstd3, [1, 200_000], [13, 200_000] ],
-    'dedup-zstd3': [DedupZstd3, [10, 200_000] ],
-    'dedup-zstd-dict': [DedupZstdDict, [10, 100_000, 100_000], [10, 100_000, 200_000], [10, 200_000, 100_000], [10, 200_000, 200_000]],
-    'dedup-zstd-dict2': [DedupZstdDict2, [10, 100_000, 100_000], [10, 100_000, 200_000], [10, 200_000, 100_000], [10, 200_000, 200_000]],
-    'dedup-zstd-dict3': [DedupZstdDict3, [10, 200_000, 10_000], [10, 200_000, 20_000], [10, 200_000, 40_000], [10, 240_000, 40_000], [19, 200_000, 20_000]],
-}
+MAX_BATCH_SIZE = args.batch_size
+FINGERPRINT_BYTES = args.fp_bits // 8
+
+def arrivals_enabled():
+    return args.arrival_rate != None or args.timestamp_field != None
+
+# A named, typed processor param. Grids, sweeps and --space values are given by name and checked
+# against these, and processors get them as keyword arguments.
+class Param:
+    def __init__(self, name, type, choices=None):
+        self.name = name
+        self.type = type
+        self.choices = choices
+
+    def check(self, algo, value):
+        # ints are fine where floats are expected, bools are not ints
+        ok = type(value) == self.type or (self.type == float and type(value) == int)
+        if not ok:
+            raise Exception(f'{algo}: {self.name} must be {self.type.__name__}, got {value!r}')
+        if self.choices != None and value not in self.choices:
+            raise Exception(f'{algo}: {self.name} must be one of {",".join(str(c) for c in self.choices)}, got {value!r}')
+        return value
+
+    # text from the command line
+    def parse(self, algo, text):
+        try:
+            value = self.type(text)
+        except ValueError:
+            raise Exception(f'{algo}: {self.name} must be {self.type.__name__}, got {text!r}')
+        return self.check(algo, value)
+
+class AlgoSpec:
+    def __init__(self, name, cls, params, grid, requires):
+        self.name = name
+        self.cls = cls
+        self.params = params
+        self.grid = grid
+        # modules the processor needs, checked before building it so a missing codec fails early
+        self.requires = requires
+        for values in grid:
+            self.check(values)
+
+    def param_names(self):
+        return [p.name for p in self.params]
+
+    def check(self, values):
+        missing = [n for n in self.param_names() if n not in values]
+        unknown = [n for n in values if n not in self.param_names()]
+        if len(missing) > 0 or len(unknown) > 0:
+            raise Exception(f'{self.name}: missing params {missing}, unknown params {unknown}, expected {self.param_names()}')
+        for p in self.params:
+            p.check(self.name, values[p.name])
+
+    def make(self, values, max_batch_size):
+        for module in self.requires:
+            if importlib.util.find_spec(module) == None:
+                raise Exception(f'{self.name} needs the {module} module, which is not installed')
+        self.check(values)
+        return self.cls(**values, max_batch_size=max_batch_size)
+
+    def describe(self):
+        params = ', '.join(f'{p.name}:{p.type.__name__}' + (f'[{"|".join(str(c) for c in p.choices)}]' if p.choices != None else '') for p in self.params)
+        return f'{self.name} ({params})'
+
+algo_registry = dict()
+
+# grid is the list of configs --algo runs, each a dict of param name -> value
+def register_algo(name, cls, params, grid, requires=[]):
+    if name in algo_registry:
+        raise Exception(f'algorithm {name} is already registered')
+    algo_registry[name] = AlgoSpec(name, cls, params, grid, requires)
+
+ENTRY_POINT_GROUP = 'compression_sim.algos'
+plugins_loaded = False
+
+# Third party algorithms come from --plugin modules and the compression_sim.algos entry points. Both
+# point to a register(sim) function that gets this module, to subclass LineProcessor and call
+# register_algo. Entry points are only looked up for names that aren't built in.
+def load_plugins(entry_points):
+    global plugins_loaded
+    if plugins_loaded:
+        return
+    plugins_loaded = True
+    this = sys.modules[__name__]
+    for name in args.plugin:
+        importlib.import_module(name).register(this)
+    if entry_points:
+        for ep in metadata.entry_points(group=ENTRY_POINT_GROUP):
+            ep.load()(this)
+
+def get_algo(name):
+    if name not in algo_registry:
+        load_plugins(True)
+    if name not in algo_registry:
+        raise Exception(f'unknown algorithm {name}, --list-algos shows the registered ones')
+    return algo_registry[name]
+
+LEVEL = Param('level', int)
+DICT_SIZE = Param('max_dict_size', int)
+ZDICT_SIZE = Param('max_zdict_size', int)
+
+register_algo('zlib', Deflate, [LEVEL], [{'level': 1}, {'level': -1}, {'level': 9}])
+register_algo('zstd', Zstd, [LEVEL], [{'level': -1}, {'level': 0}, {'level': 19}], ['zstandard'])
+register_algo('zstd-dict', ZstdDict, [LEVEL, Param('train_dict_size', int)],
+    [{'level': 13, 'train_dict_size': 220_000}, {'level': 13, 'train_dict_size': 140_000}], ['zstandard'])
+register_algo('brotli', Brotli, [LEVEL], [{'level': 0}, {'level': 3}, {'level': 11}], ['brotli'])
+register_algo('snappy', Snappy, [], [{}], ['snappy'])
+register_algo('stream-zlib', StreamDeflate, [LEVEL], [{'level': 1}, {'level': 6}, {'level': 9}])
+register_algo('stream-zstd', StreamZstd, [LEVEL], [{'level': 1}, {'level': 3}, {'level': 13}, {'level': 19}], ['zstandard'])
+register_algo('stream-brotli', StreamBrotli, [LEVEL], [{'level': 1}, {'level': 5}, {'level': 9}], ['brotli'])
+register_algo('columnar', Columnar, [LEVEL, Param('shuffle', int, [0, 1])],
+    [{'level': 3, 'shuffle': 0}, {'level': 3, 'shuffle': 1}, {'level': 13, 'shuffle': 1}, {'level': 19, 'shuffle': 1}], ['zstandard'])
+register_algo('dedup', DedupSimple, [DICT_SIZE],
+    [{'max_dict_size': 10_000}, {'max_dict_size': 20_000}, {'max_dict_size': 60_000}, {'max_dict_size': 100_000}])
+register_algo('dedup-zstd', DedupZstd, [LEVEL, DICT_SIZE],
+    [{'level': 1, 'max_dict_size': 200_000}, {'level': 13, 'max_dict_size': 200_000}], ['zstandard'])
+register_algo('dedup-zstd-adaptive', DedupZstdAdaptive, [LEVEL, DICT_SIZE, Param('min_dict_size', int)],
+    [{'level': 1, 'max_dict_size': 200_000, 'min_dict_size': 10_000}, {'level': 13, 'max_dict_size': 200_000, 'min_dict_size': 10_000}], ['zstandard'])
+register_algo('dedup-zstd2', DedupZstd2, [LEVEL, DICT_SIZE], [{'level': 10, 'max_dict_size': 200_000}], ['zstandard'])
+register_algo('dedup-zstd3', DedupZstd3, [LEVEL, DICT_SIZE], [{'level': 10, 'max_dict_size': 200_000}], ['zstandard'])
+register_algo('dedup-zstd-rolling', DedupZstdRolling, [LEVEL, DICT_SIZE, Param('policy', str, DedupZstdRolling.POLICIES)],
+    [{'level': 10, 'max_dict_size': 200_000, 'policy': policy} for policy in DedupZstdRolling.POLICIES], ['zstandard'])
+ZDICT_GRID = [{'level': 10, 'max_dict_size': d, 'max_zdict_size': z} for d in [100_000, 200_000] for z in [100_000, 200_000]]
+register_algo('dedup-zstd-dict', DedupZstdDict, [LEVEL, DICT_SIZE, ZDICT_SIZE], ZDICT_GRID, ['zstandard'])
+register_algo('dedup-zstd-dict2', DedupZstdDict2, [LEVEL, DICT_SIZE, ZDICT_SIZE], ZDICT_GRID, ['zstandard'])
+register_algo('dedup-zstd-dict3', DedupZstdDict3, [LEVEL, DICT_SIZE, ZDICT_SIZE],
+    [{'level': 10, 'max_dict_size': 200_000, 'max_zdict_size': 10_000}, {'level': 10, 'max_dict_size': 200_000, 'max_zdict_size': 20_000},
+     {'level': 10, 'max_dict_size': 200_000, 'max_zdict_size': 40_000}, {'level': 10, 'max_dict_size': 240_000, 'max_zdict_size': 40_000},
+     {'level': 19, 'max_dict_size': 200_000, 'max_zdict_size': 20_000}], ['zstandard'])
 
 def gen_compression_list(algos):
     res = []
     for name in algos:
-        x = compression_algos[name]
-        if len(x) == 1:
-            res.append(x[0](MAX_BATCH_SIZE))
-        else:
-            for i in range(1, len(x)):
-                res.append(x[0](x[i], MAX_BATCH_SIZE))
+        spec = get_algo(name)
+        for values in spec.grid:
+            res.append(spec.make(values, MAX_BATCH_SIZE))
     return res
 
 def gen_sweep_list():
     res = []
     # 240_000 is the previously know best dict size
+    spec = get_algo('dedup-zstd2')
     for level in range(0, 19):
-        res.append(DedupZstd2([level, 240_000], MAX_BATCH_SIZE))
+        res.append(spec.make({'level': level, 'max_dict_size': 240_000}, MAX_BATCH_SIZE))
     
     # 13 is the previously best well known compression level
     for i in range(8, 30):
-        res.append(DedupZstd2([13, i * 10_000], MAX_BATCH_SIZE))
+        res.append(spec.make({'level': 13, 'max_dict_size': i * 10_000}, MAX_BATCH_SIZE))
     return res
 
 def gen_sweep_list2():
     res = []
     for l in [1, 13]:
         for max_dict in [80_000, 160_000, 240_000]:
-            res.append(DedupZstd([l, max_dict], MAX_BATCH_SIZE))
-            res.append(ZstdDict([l, max_dict], MAX_BATCH_SIZE))
-            res.append(DedupZstdDict3([l, max_dict, max_dict], MAX_BATCH_SIZE))
+            res.append(get_algo('dedup-zstd').make({'level': l, 'max_dict_size': max_dict}, MAX_BATCH_SIZE))
+            res.append(get_algo('zstd-dict').make({'level': l, 'train_dict_size': max_dict}, MAX_BATCH_SIZE))
+            res.append(get_algo('dedup-zstd-dict3').make({'level': l, 'max_dict_size': max_dict, 'max_zdict_size': max_dict}, MAX_BATCH_SIZE))
     return res
 
 
-def gen_clients(args):
+def gen_proc_list():
+    if args.sweep:
+        return gen_sweep_list()
+    if args.sweep2:
+        return gen_sweep_list2()
+    return gen_compression_list(algo_names)
+
+# the clients with ids client_ids (all of them by default), every one with the same processor list
+def gen_clients(args, client_ids=None):
     clients = []
-    for i in range(0, args.clients):
+    for i in client_ids if client_ids != None else range(0, args.clients):
         c = Client(i)
-        if args.sweep:
-            for p in gen_sweep_list():
-                c.add_proc(p)
-        elif args.sweep2:
-            for p in gen_sweep_list2():
-                c.add_proc(p)
-        else:
-            for p in gen_compression_list(algo_names):
-                c.add_proc(p)
+        procs = gen_proc_list()
+        if args.async_train != 'off':
+            async_procs = [p for p in gen_proc_list() if p.trainer != None]
+            for p in async_procs:
+                p.enable_async_train()
+            if args.async_train == 'on':
+                procs = [p for p in procs if p.trainer == None]
+            procs.extend(async_procs)
+        for p in procs:
+            if args.flush_ms != None:
+                p.enable_deadline(args.flush_ms)
+            if args.memory_budget != None:
+                p.enable_memory_budget(args.memory_budget, args.shed_memory)
+            if args.restart_every > 0 or args.drop_every > 0:
+                p.enable_faults(args.restart_every, args.drop_every)
+            if args.wire:
+                p.enable_wire()
+            c.add_proc(p)
         clients.append(c)
     return clients
 
-for cur_file in tqdm(args.files):
-    with open(cur_file, 'r+') as input:
-        c = gen_clients(args)[0]
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+def sniff_input(file_name):
+    with open(file_name, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic == ZSTD_MAGIC:
+        return 'zstd'
+    return None
+
+# binary reader that transparently decompresses gzip/zstd captures
+def open_input(file_name):
+    codec = sniff_input(file_name)
+    if codec == 'gzip':
+        return gzip.open(file_name, 'rb')
+    if codec == 'zstd':
+        return zstd.ZstdDecompressor().stream_reader(open(file_name, 'rb'))
+    return open(file_name, 'rb')
+
+# Yields lines (with their trailing newline, like readlines) while holding at most one chunk plus
+# one partial line in memory.
+def iter_stream_lines(stream, chunk_size):
+    # pieces of a line spanning chunks, joined once its end shows up so long lines stay linear
+    pending = []
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        start = 0
+        while True:
+            end = chunk.find(b'\n', start)
+            if end == -1:
+                break
+            if pending:
+                pending.append(chunk[start:end + 1])
+                yield b''.join(pending)
+                pending = []
+            else:
+                yield chunk[start:end + 1]
+            start = end + 1
+        if start < len(chunk):
+            pending.append(chunk[start:])
+    if pending:
+        yield b''.join(pending)
+
+# mmap-backed variant for uncompressed files, the page cache does the buffering for us
+def iter_mmap_lines(file_name):
+    with open(file_name, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            size = len(mm)
+            while start < size:
+                end = mm.find(b'\n', start)
+                end = size if end == -1 else end + 1
+                yield mm[start:end]
+                start = end
+
+def read_lines(file_name):
+    if args.mmap and sniff_input(file_name) == None:
+        yield from iter_mmap_lines(file_name)
+        return
+    with open_input(file_name) as input:
+        yield from iter_stream_lines(input, args.chunk_size)
+
+SHARED_FIELD = b'"TShared":'
+shared_decoder = json.JSONDecoder()
+
+def shard_line(line_no, line, n_clients):
+    if n_clients == 1:
+        return 0
+    if args.shard == 'shared':
+        # events with the same shared context (same user/device) always go to the same client. Every
+        # worker sees every line, so only the shared context is decoded and not the actions
+        pos = line.find(SHARED_FIELD)
+        if pos != -1:
+            shared = shared_decoder.raw_decode(str(line[pos + len(SHARED_FIELD):], 'utf-8').lstrip())[0]
+        else:
+            shared = json.loads(line)["c"].get("TShared")
+        return zlib.crc32(bytes(json.dumps(shared, sort_keys=True), 'utf-8')) % n_clients
+    return line_no % n_clients
+
+# Results of finished (file, client, processor) runs keyed by everything that can change them, so
+# rerunning a sweep only computes the configs that are new. Bump CACHE_VERSION when a change to the
+# processors makes old results wrong.
+CACHE_VERSION = 9
+
+def lib_versions():
+    res = [zlib.ZLIB_RUNTIME_VERSION]
+    for lib in ['zstandard', 'brotli', 'python-snappy']:
+        try:
+            res.append(metadata.version(lib))
+        except metadata.PackageNotFoundError:
+            res.append(None)
+    return res
+
+class ResultCache:
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.file_hashes = dict()
+        self.versions = lib_versions()
+
+    def file_hash(self, file_name):
+        if file_name not in self.file_hashes:
+            h = hashlib.sha256()
+            with open(file_name, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    h.update(chunk)
+            self.file_hashes[file_name] = h.hexdigest()
+        return self.file_hashes[file_name]
+
+    # must be called before the processor runs, its plain attributes are its params
+    def key(self, file_name, client_id, proc):
+        params = sorted((k, v) for k, v in vars(proc).items() if type(v) in (int, float, str, bool))
+        settings = [CACHE_VERSION, self.versions, MAX_BATCH_SIZE, FINGERPRINT_BYTES, args.clients, args.shard, client_id, args.wire,
+                    args.arrival_rate, args.arrival_seed, args.timestamp_field]
+        desc = repr([self.file_hash(file_name), type(proc).__name__, proc.label, params, settings])
+        return hashlib.sha256(bytes(desc, 'utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f'{key}.pkl')
+
+    def entries(self):
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith('.pkl'):
+                    yield os.path.join(root, name)
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                entry = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        # eviction goes by mtime, so a hit counts as a use
+        os.utime(self.path(key))
+        return entry
+
+    def put(self, key, entry):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f'{path}.tmp', 'wb') as f:
+            pickle.dump(entry, f)
+        os.replace(f'{path}.tmp', path)
+
+    def evict(self):
+        files = [(os.stat(p), p) for p in self.entries()]
+        total = sum(st.st_size for st, _ in files)
+        for st, p in sorted(files, key=lambda x: x[0].st_mtime):
+            if total <= self.max_bytes:
+                break
+            os.remove(p)
+            total -= st.st_size
+
+    def invalidate(self, pattern):
+        removed = 0
+        for p in list(self.entries()):
+            with open(p, 'rb') as f:
+                entry = pickle.load(f)
+            if pattern == 'all' or pattern in entry['label'] or pattern in entry['file']:
+                os.remove(p)
+                removed += 1
+        print(f'removed {removed} cached results from {self.cache_dir}')
+
+result_cache = None if args.no_cache else ResultCache(args.cache_dir, args.cache_max_mb * 1024 * 1024)
+
+# loads the processors every client has cached, returns the indexes of the ones still to run and
+# the cache keys for them. A processor is only skipped if all clients have it, so they still share
+# the run over the file with the others.
+def load_cached(cur_file, clients):
+    if result_cache == None:
+        return list(range(0, len(clients[0].procs))), dict()
+    todo = []
+    keys = dict()
+    for i in range(0, len(clients[0].procs)):
+        proc_keys = [result_cache.key(cur_file, c.id, c.procs[i]) for c in clients]
+        entries = [result_cache.get(k) for k in proc_keys]
+        if all(e != None for e in entries):
+            for c, e in zip(clients, entries):
+                c.procs[i].set_results(e['results'])
+                c.lines = e['lines']
+                c.raw_size = e['raw_size']
+        else:
+            todo.append(i)
+            for c, k in zip(clients, proc_keys):
+                keys[(c.id, i)] = k
+    return todo, keys
+
+def store_results(cur_file, clients, keys):
+    if result_cache == None or len(keys) == 0:
+        return
+    for c in clients:
+        for i, p in enumerate(c.procs):
+            if (c.id, i) in keys:
+                result_cache.put(keys[(c.id, i)], { 'label': p.label, 'file': cur_file, 'lines': c.lines, 'raw_size': c.raw_size, 'results': p.get_results() })
+    result_cache.evict()
+
+# clients maps client id -> Client and may hold only a subset of the args.clients shards
+def run_file(cur_file, clients, progress=True):
+    for c in clients.values():
         c.start()
-        cur_line = 0
-        for line in tqdm(input.readlines()):
-            c.add_line(line)
+    lines = read_lines(cur_file)
+    for line_no, line in enumerate(progress_bar(lines, unit=' lines') if progress else lines):
+        c = clients.get(shard_line(line_no, line, args.clients))
+        if c != None:
+            c.add_bytes(line)
+    # the end of the file ships what is left, a client with many shards may never fill a batch
+    for c in clients.values():
+        c.flush()
+
+# worker entry point: runs the processors at proc_indexes (as built by gen_clients) for the
+# clients in client_ids over one file
+def run_task(task):
+    cur_file, client_ids, proc_indexes = task
+    clients = dict()
+    for full in gen_clients(args, client_ids):
+        c = Client(full.id)
+        for j in proc_indexes:
+            c.add_proc(full.procs[j])
+        clients[c.id] = c
+    run_file(cur_file, clients, progress=False)
+    return cur_file, proc_indexes, [(c.id, c.lines, c.raw_size, [p.get_results() for p in c.procs]) for c in clients.values()]
+
+# Each (client, processor) pair is an independent stream, so we split files, clients and processors
+# across a process pool and merge the results back into freshly built clients per file.
+def run_parallel(files, jobs):
+    clients = dict()
+    tasks = []
+    keys = dict()
+    for cur_file in files:
+        clients[cur_file] = gen_clients(args)
+        todo, keys[cur_file] = load_cached(cur_file, clients[cur_file])
+        n_procs = len(todo)
+        if n_procs == 0:
+            continue
+        # enough tasks to keep all workers busy, but no more as each task re-reads the file
+        per_file = max(1, jobs // len(files))
+        n_groups = min(args.clients, per_file)
+        n_chunks = min(n_procs, max(1, per_file // n_groups))
+        for g in range(0, n_groups):
+            for i in range(0, n_chunks):
+                # interleave so expensive configs (high levels, big dicts) get spread across chunks
+                tasks.append((cur_file, list(range(g, args.clients, n_groups)), todo[i::n_chunks]))
+
+    with multiprocessing.Pool(jobs) as pool:
+        for cur_file, proc_indexes, client_results in progress_bar(pool.imap_unordered(run_task, tasks), total=len(tasks)):
+            for client_id, lines, raw_size, results in client_results:
+                c = clients[cur_file][client_id]
+                c.lines = lines
+                c.raw_size = raw_size
+                for i, r in zip(proc_indexes, results):
+                    c.procs[i].set_results(r)
+    for f in files:
+        store_results(f, clients[f], keys[f])
+    return [(f, clients[f]) for f in files]
+
+def run_sequential(files):
+    for cur_file in progress_bar(files):
+        clients = gen_clients(args)
+        todo, keys = load_cached(cur_file, clients)
+        if len(todo) > 0:
+            # same as run_task, the subset clients share the processors with the full ones
+            run_clients = dict()
+            for c in clients:
+                run_clients[c.id] = Client(c.id)
+                for i in todo:
+                    run_clients[c.id].add_proc(c.procs[i])
+            run_file(cur_file, run_clients)
+            for c in clients:
+                c.lines = run_clients[c.id].lines
+                c.raw_size = run_clients[c.id].raw_size
+            store_results(cur_file, clients, keys)
+        yield cur_file, clients
+
+# ratios over the union of all clients' batches and spread of the per-client ratios
+def report_clients(clients):
+    print(f'{len(clients)} clients lines:{sum(c.lines for c in clients)} raw-size:{sum(c.raw_size for c in clients)}')
+    for i, p in enumerate(clients[0].procs):
+        procs = [c.procs[i] for c in clients if len(c.procs[i].batches) > 0]
+        if len(procs) == 0:
+            print(f'{p.label} no complete batches')
+            continue
+        n = np.array([b for q in procs for b in q.batches])
+        client_ratios = [q.mean_ratio() for q in procs]
+        print(f'{p.label} clients:{len(procs)} batches:{len(n)}')
+        print(f'\taggregate-ratio: {np.sum(n[:,1]) / np.sum(n[:,0]):2.2f} mean-client-ratio: {np.mean(client_ratios):2.2f} min-client-ratio: {np.min(client_ratios):2.2f} max-client-ratio: {np.max(client_ratios):2.2f}')
+
+# Guided search: the grid sweeps above run every config over every line, which for 3 params takes
+# days. Instead we start from a few random configs on a short prefix of the input, keep the best
+# 1/eta of them for eta times more lines until the whole input (successive halving), then move the
+# winner one step at a time along each param while it keeps improving (hill climbing).
+# specs are name=values, or just values in the order the algorithm declares its params. values are
+# either lo:hi:step (ints) or a comma separated list. Returns the values of every param in order
+def parse_space(algo, specs):
+    params = get_algo(algo).params
+    by_name = dict()
+    for i, spec in enumerate(specs):
+        name, sep, values = spec.partition('=')
+        if sep == '':
+            if i >= len(params):
+                raise Exception(f'{algo} has {len(params)} params, got {len(specs)} --space values')
+            name, values = params[i].name, spec
+        by_name[name] = values
+    unknown = [n for n in by_name if n not in get_algo(algo).param_names()]
+    if len(unknown) > 0:
+        raise Exception(f'{algo}: unknown params {unknown}, expected {get_algo(algo).param_names()}')
+    space = []
+    for p in params:
+        if p.name not in by_name:
+            raise Exception(f'{algo}: no --space values for {p.name}')
+        values = by_name[p.name]
+        if ':' in values and p.type == int:
+            lo, hi, step = (p.parse(algo, x) for x in values.split(':'))
+            space.append(list(range(lo, hi + 1, step)))
+        else:
+            space.append([p.parse(algo, x) for x in values.split(',')])
+    return space
+
+# params are the values of the algorithm's params in order
+def make_proc(algo, params):
+    spec = get_algo(algo)
+    return spec.make(dict(zip(spec.param_names(), params)), MAX_BATCH_SIZE)
+
+# runs all configs over the first max_lines of each file (all of it if None) in a single pass
+def eval_configs(task):
+    algo, configs, files, max_lines = task
+    scores = dict((cfg, []) for cfg in configs)
+    for cur_file in files:
+        c = Client(0)
+        for cfg in configs:
+            p = make_proc(algo, cfg)
+            if args.wire:
+                p.enable_wire()
+            c.add_proc(p)
+        c.start()
+        for line in itertools.islice(read_lines(cur_file), max_lines):
+            c.add_bytes(line)
+        for cfg, p in zip(configs, c.procs):
+            # like run_file, so a short prefix still gives a high ratio config a batch and every config
+            # is scored with its tail
+            p.flush()
+            scores[cfg].append(p.mean_ratio())
+    return dict((cfg, np.mean(r)) for cfg, r in scores.items())
+
+class ParamSearch:
+    def __init__(self, algo, space, files):
+        if len(get_algo(algo).params) == 0:
+            raise Exception(f'{algo} has no params to search')
+        self.algo = algo
+        self.space = space
+        self.files = files
+        self.total_lines = max(sum(1 for _ in read_lines(f)) for f in files)
+        # (config, lines) -> mean ratio
+        self.scores = dict()
+        self.lines_processed = 0
+        # stage, lines, config, mean ratio
+        self.log = []
+
+    def grid_size(self):
+        return math.prod(len(values) for values in self.space)
+
+    # scores the configs not seen yet at this budget, across the pool with --jobs
+    def evaluate(self, configs, lines, stage):
+        if lines >= self.total_lines:
+            lines = self.total_lines
+        todo = [cfg for cfg in configs if (cfg, lines) not in self.scores]
+        if len(todo) > 0:
+            if args.jobs > 1 and len(todo) > 1:
+                n_chunks = min(args.jobs, len(todo))
+                tasks = [(self.algo, todo[i::n_chunks], self.files, lines) for i in range(0, n_chunks)]
+                with multiprocessing.Pool(n_chunks) as pool:
+                    results = pool.map(eval_configs, tasks)
+            else:
+                results = [eval_configs((self.algo, todo, self.files, lines))]
+            for res in results:
+                for cfg, score in res.items():
+                    self.scores[(cfg, lines)] = score
+                    self.log.append([stage, lines, cfg, score])
+            self.lines_processed += len(todo) * lines * len(self.files)
+        return dict((cfg, self.scores[(cfg, lines)]) for cfg in configs)
+
+    def initial_configs(self, rng):
+        if self.grid_size() <= args.search_configs:
+            return list(itertools.product(*self.space))
+        configs = set()
+        while len(configs) < args.search_configs:
+            configs.add(tuple(rng.choice(values) for values in self.space))
+        return sorted(configs, key=str)
+
+    def neighbours(self, cfg):
+        res = []
+        for i, values in enumerate(self.space):
+            idx = values.index(cfg[i])
+            for j in [idx - 1, idx + 1]:
+                if j >= 0 and j < len(values):
+                    res.append(cfg[:i] + (values[j],) + cfg[i + 1:])
+        return res
 
+    def successive_halving(self, configs):
+        lines = args.search_lines
+        round = 0
+        while True:
+            scores = self.evaluate(configs, lines, f'halving-{round}')
+            configs = sorted(configs, key=lambda cfg: scores[cfg], reverse=True)
+            print(f'round {round} lines:{min(lines, self.total_lines)} configs:{len(configs)} best:{configs[0]} ratio:{scores[configs[0]]:.3f}')
+            if lines >= self.total_lines or len(configs) == 1:
+                break
+            configs = configs[:max(1, len(configs) // args.search_eta)]
+            lines *= args.search_eta
+            round += 1
+        return configs[0]
+
+    def hill_climb(self, cfg):
+        score = self.evaluate([cfg], self.total_lines, 'climb')[cfg]
+        while True:
+            scores = self.evaluate(self.neighbours(cfg), self.total_lines, 'climb')
+            if len(scores) == 0:
+                break
+            best = max(scores, key=lambda x: scores[x])
+            if scores[best] <= score:
+                break
+            cfg, score = best, scores[best]
+            print(f'climb to {cfg} ratio:{score:.3f}')
+        return cfg, score
+
+    def run(self):
+        rng = random.Random(args.search_seed)
+        cfg, score = self.hill_climb(self.successive_halving(self.initial_configs(rng)))
+        full_evals = len([x for x in self.scores if x[1] == self.total_lines])
+        grid_lines = self.grid_size() * self.total_lines * len(self.files)
+        names = get_algo(self.algo).param_names()
+        print(f'{self.algo} best:{" ".join(f"{n}={v}" for n, v in zip(names, cfg))} ratio:{score:.3f} ({make_proc(self.algo, cfg).label})')
+        print(f'\tevaluations:{len(self.scores)} full-input:{full_evals} grid:{self.grid_size()} lines-processed:{self.lines_processed / grid_lines * 100:.1f}% of the grid')
+
+    def write_csv(self, out_file):
+        out_file.write('algo,stage,lines,params,mean_ratio\n')
+        for stage, lines, cfg, score in self.log:
+            out_file.write(f'{self.algo},{stage},{lines},{"_".join(str(x) for x in cfg)},{score}\n')
+
+# Estimation: most sweep decisions only need a ranking, so instead of every line we run fresh
+# processors over a few contiguous windows of each file, one at a random offset in each equal slice
+# of it. Windows keep the dict history a full run would have, apart from their first
+# --estimate-warmup batches which are left out. Windows are the sampling unit: the intervals come
+# from how much they disagree, and processors whose intervals overlap can be run in full to settle it.
+
+# two sided 95% t quantiles by degrees of freedom, the normal one past the table
+T95 = [12.71, 4.30, 3.18, 2.78, 2.57, 2.45, 2.36, 2.31, 2.26, 2.23, 2.20, 2.18, 2.16, 2.14, 2.13, 2.12, 2.11, 2.10, 2.09, 2.09]
+
+def t95(df):
+    return T95[df - 1] if df <= len(T95) else 1.96
+
+# mean over the batches of all windows and the half width of its 95% interval. Batches within a
+# window are not independent, so the error comes from how far each window's sum is from the mean
+def cluster_mean(windows):
+    counts = np.array([len(w) for w in windows])
+    sums = np.array([np.sum(w) for w in windows])
+    mean = np.sum(sums) / np.sum(counts)
+    k = len(windows)
+    if k < 2:
+        return mean, math.inf
+    var = k / (k - 1) * np.sum((sums - mean * counts) ** 2) / np.sum(counts) ** 2
+    return mean, t95(k - 1) * math.sqrt(var)
+
+# (start line, lines) of each window
+def sample_windows(total_lines, rng):
+    n = args.estimate_windows
+    length = max(1, int(total_lines * args.estimate / n))
+    windows = []
+    for i in range(0, n):
+        lo = i * total_lines // n
+        hi = max(lo, (i + 1) * total_lines // n - length)
+        windows.append((rng.randint(lo, hi), length))
+    return windows
+
+# worker entry point: the batches of every processor (as built by gen_clients) past the warmup
+def run_window(task):
+    cur_file, start, length = task
+    c = gen_clients(args)[0]
+    c.start()
+    for line in itertools.islice(read_lines(cur_file), start, start + length):
+        c.add_bytes(line)
+    return [p.batches[args.estimate_warmup:] for p in c.procs]
+
+class Estimate:
+    def __init__(self, label, windows):
+        self.label = label
+        self.windows = len(windows)
+        self.batches = sum(len(w) for w in windows)
+        self.ratio = self.header = (math.nan, math.inf)
+        if self.windows > 0:
+            self.ratio = cluster_mean([w[:,1] / w[:,0] for w in windows])
+            self.header = cluster_mean([w[:,3] for w in windows])
+        # the processor after a full run with --escalate
+        self.full = None
+
+    def overlaps(self, other):
+        return abs(self.ratio[0] - other.ratio[0]) <= self.ratio[1] + other.ratio[1]
+
+    def report(self):
+        print(f'{self.label} windows:{self.windows} batches:{self.batches}')
+        if self.windows == 0:
+            print('\tno batches past the warmup, windows need more lines')
+        else:
+            print(f'\test-ratio: {self.ratio[0]:2.2f} ±{self.ratio[1]:.2f} est-header:{self.header[0]:.0f} ±{self.header[1]:.0f}')
+        if self.full != None and len(self.full.batches) > 0:
+            n = np.array(self.full.batches)
+            print(f'\tfull run mean-ratio: {self.full.mean_ratio():2.2f} mean-header:{int(np.mean(n[:,3]))}')
+
+    def gen_csv(self, file_name, out_file):
+        full = ','
+        if self.full != None and len(self.full.batches) > 0:
+            n = np.array(self.full.batches)
+            full = f'{self.full.mean_ratio()},{np.mean(n[:,3])}'
+        out_file.write(f'{file_name},{self.label},{self.windows},{self.batches},{self.ratio[0]},{self.ratio[1]},{self.header[0]},{self.header[1]},{int(self.full != None)},{full}\n')
+
+# full runs (through the result cache) of the processors at indexes, returns all the processors
+# and how many of them had to run
+def run_full(cur_file, indexes):
+    clients = gen_clients(args)
+    todo, keys = load_cached(cur_file, clients)
+    todo = [i for i in todo if i in indexes]
+    if len(todo) > 0:
+        c = clients[0]
+        run_client = Client(c.id)
+        for i in todo:
+            run_client.add_proc(c.procs[i])
+        run_file(cur_file, { c.id: run_client })
+        c.lines = run_client.lines
+        c.raw_size = run_client.raw_size
+        store_results(cur_file, clients, dict((k, v) for k, v in keys.items() if k[1] in todo))
+    return clients[0].procs, len(todo)
+
+def estimate_file(cur_file, pool):
+    total_lines = sum(1 for _ in read_lines(cur_file))
+    windows = sample_windows(total_lines, random.Random(args.estimate_seed))
+    tasks = [(cur_file, start, length) for start, length in windows]
+    results = pool.map(run_window, tasks) if pool != None else [run_window(t) for t in progress_bar(tasks, unit=' windows')]
+    procs = gen_clients(args)[0].procs
+    estimates = []
+    for i, p in enumerate(procs):
+        estimates.append(Estimate(p.label, [np.array(res[i]) for res in results if len(res[i]) > 0]))
+
+    sampled = sum(length for _, length in windows)
+    lines_processed = sampled * len(procs)
+    if args.escalate:
+        # without an interval there is nothing to rank by
+        escalate = [i for i, e in enumerate(estimates) if e.windows < 2 or any(e.overlaps(o) for o in estimates if o is not e)]
+        full_procs, n_run = run_full(cur_file, escalate)
+        for i in escalate:
+            estimates[i].full = full_procs[i]
+        lines_processed += total_lines * n_run
+
+    print(f'{cur_file} lines:{total_lines} windows:{len(windows)} of {windows[0][1]} lines, warmup:{args.estimate_warmup} batches')
+    for e in estimates:
+        e.report()
+    print(f'lines processed: {lines_processed / max(1, total_lines * len(procs)) * 100:.1f}% of a full run')
+    if args.csv:
+        with open(f'{args.prefix}{cur_file}.estimate.csv', 'w') as out:
+            out.write('file,name,windows,batches,est_mean_ratio,ratio_ci95,est_mean_header,header_ci95,escalated,mean_ratio,mean_header\n')
+            for e in estimates:
+                e.gen_csv(cur_file, out)
+
+def write_results(cur_file, clients):
     if args.csv:
         with open(f'{args.prefix}{cur_file}.csv', 'w') as stats:
             stats.write('file,client,total_lines,raw_size,name,n_batches,mean_ratio,mean_lines,mean_header,mean_batch_size')
-            if c.procs[0].get_header() != None:
-                stats.write(f',{c.procs[0].get_header()}')
+            if clients[0].procs[0].get_extra_header() != None:
+                stats.write(f',{clients[0].procs[0].get_extra_header()}')
+            if clients[0].procs[0].get_header() != None:
+                stats.write(f',{clients[0].procs[0].get_header()}')
             stats.write('\n')
-            c.gen_csv(cur_file, stats)
+            for c in clients:
+                c.gen_csv(cur_file, stats)
     else:
-        c.finish()
-
+        for c in clients:
+            c.finish()
+    if len(clients) > 1:
+        report_clients(clients)
+
+if __name__ == '__main__':
+    if args.list_algos:
+        load_plugins(True)
+        for spec in algo_registry.values():
+            print(spec.describe())
+            for values in spec.grid:
+                print(f'\t{" ".join(f"{k}={v}" for k, v in values.items())}')
+        exit(0)
+    if args.cache_invalidate != None:
+        ResultCache(args.cache_dir, 0).invalidate(args.cache_invalidate)
+        if len(args.files) == 0:
+            exit(0)
+    if args.search != None:
+        if args.space == None:
+            raise Exception('--search needs a --space for each param')
+        search = ParamSearch(args.search, parse_space(args.search, args.space), args.files)
+        search.run()
+        if args.csv:
+            with open(f'{args.prefix}search_{args.search}.csv', 'w') as out:
+                search.write_csv(out)
+    elif args.estimate != None:
+        pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+        for cur_file in args.files:
+            estimate_file(cur_file, pool)
+        if pool != None:
+            pool.close()
+    else:
+        if args.jobs > 1:
+            runs = run_parallel(args.files, args.jobs)
+        else:
+            runs = run_sequential(args.files)
+        for cur_file, clients in runs:
+            write_results(cur_file, clients)
@@ -0,0 +1,55 @@
+import csv;
+import os;
+import subprocess;
+import sys;
+
+import pytest;
+
+# Round trips every wire format through sim.py --wire: batches are encoded, decoded back and each
+# line compared with the original. A small batch size puts a batch boundary every few lines, so
+# the lines that overflow one batch and go into the next (reprocessed or reused) are covered too.
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+BATCH_SIZE = 30000
+
+@pytest.fixture(scope='module')
+def log_file(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp('logs')
+    subprocess.run([sys.executable, os.path.join(REPO, 'gen-batches.py'), '--set1', '--decisions', '120', '--seed', '1', '--name', 'log'],
+        cwd=tmp, check=True, capture_output=True)
+    return tmp, 'log_1000.in'
+
+def run_wire(log_file, algo, *extra):
+    cwd, name = log_file
+    subprocess.run([sys.executable, os.path.join(REPO, 'sim.py'), '--no-cache', '--wire', '--csv', '--prefix', 'out_',
+        '--batch-size', str(BATCH_SIZE), '--algo', algo, *extra, name], cwd=cwd, check=True, capture_output=True)
+    with open(os.path.join(cwd, f'out_{name}.csv')) as f:
+        return list(csv.DictReader(f))
+
+def check_round_trip(rows):
+    assert len(rows) > 0
+    for row in rows:
+        assert int(row['n_batches']) > 1, row['name']
+        assert int(row['decode_errors']) == 0, row['name']
+
+@pytest.mark.parametrize('refs', ['json', 'varint'])
+@pytest.mark.parametrize('algo', ['dedup', 'dedup-zstd', 'dedup-zstd2', 'dedup-zstd3'])
+def test_dedup_refs(log_file, algo, refs):
+    rows = run_wire(log_file, algo, '--refs', refs)
+    check_round_trip(rows)
+    # lines that went over a batch made it into the next one
+    assert all(int(row['reprocessed_lines']) + int(row['reused_lines']) > 0 for row in rows)
+
+@pytest.mark.parametrize('refs', ['json', 'varint'])
+def test_rolling_delta(log_file, refs):
+    rows = run_wire(log_file, 'dedup-zstd-rolling', '--refs', refs)
+    check_round_trip(rows)
+    assert all(int(row['reused_lines']) > 0 for row in rows)
+
+def test_rolling_resync(log_file):
+    check_round_trip(run_wire(log_file, 'dedup-zstd-rolling', '--restart-every', '3', '--drop-every', '4'))
+
+def test_columnar(log_file):
+    rows = run_wire(log_file, 'columnar')
+    check_round_trip(rows)
+    assert all(float(row['boundary_mean_overflow']) > 0 for row in rows)